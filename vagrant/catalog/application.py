@@ -4,21 +4,43 @@
 import flask
 from flask.ext import seasurf
 
+import batch
 import catalog
+import compression
 import login
 import file_upload
 import endpoints
+import metrics
+import page_cache
+import recent_items
+import search
+import sessions
+import static_files
+import template_cache
 import config
+import database
 
 
 app = flask.Flask(__name__)
 csrf = seasurf.SeaSurf(app)
 app.config['UPLOAD_FOLDER'] = config.UPLOAD_FOLDER
 app.secret_key = 'those_are_my_secretz'
+sessions.init_app(app)
+database.init_app(app)
+metrics.init_app(app)
+template_cache.init_app(app)
+static_files.init_app(app)
+compression.init_app(app)
 catalog.load_controllers(app)
 login.load_controllers(app, csrf)
 file_upload.load_controllers(app)
 endpoints.load_controllers(app)
+page_cache.load_controllers(app)
+search.load_controllers(app)
+batch.load_controllers(app, csrf)
+
+with app.app_context():
+    recent_items.warm(database.get_session())
 
 
 if __name__ == '__main__':
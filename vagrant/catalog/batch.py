@@ -0,0 +1,222 @@
+# coding: utf-8
+"""JSON API that creates, updates and deletes many items in one request.
+
+The request has a list of operations:
+
+    {"operations": [
+        {"action": "create", "category": "Soccer", "name": "Ball",
+         "description": "..."},
+        {"action": "update", "id": 12, "name": "...", "category": "..."},
+        {"action": "delete", "id": 13}
+    ]}
+
+The categories and the modified items are read with one query each, and all
+the changes are saved in one transaction. The response has a result for each
+operation, with the status that the per-item controllers would return: 201
+for a created item, 200 for an updated or deleted one, and 400, 403 or 404
+for the operations that were not applied. The other operations are applied
+even when some fail.
+"""
+
+import collections
+
+import flask
+import sqlalchemy as sqla
+
+import conditional
+import config
+import database
+import file_upload
+import page_cache
+import recent_items
+
+ACTIONS = ['create', 'update', 'delete']
+
+# Columns that can be set by the operations.
+FIELDS = ['name', 'description']
+
+
+def _error(status, message):
+    """Returns the result of an operation that was not applied."""
+    return {'status': status, 'error': message}
+
+
+def _check(operation):
+    """Returns the error of a malformed operation, or None."""
+    if not isinstance(operation, dict):
+        return 'operations must be objects'
+    action = operation.get('action')
+    if action not in ACTIONS:
+        return 'unknown action: %r' % action
+    item_id = operation.get('id')
+    if action != 'create' and (not isinstance(item_id, (int, long)) or
+                               isinstance(item_id, bool)):
+        return 'the item id is required'
+    if action == 'create' and not operation.get('category'):
+        return 'the category is required'
+    if action == 'create' and not operation.get('name'):
+        return 'the name is required'
+    for field in FIELDS + ['category']:
+        value = operation.get(field)
+        if value is not None and not isinstance(value, basestring):
+            return '%s must be a string' % field
+    if 'name' in operation and not operation['name']:
+        return 'the name can not be empty'
+    if len(operation.get('name') or '') > 100:
+        return 'the name is longer than 100 characters'
+    return None
+
+
+def _values(operation):
+    """Returns the item columns set by an operation."""
+    return dict((field, operation[field]) for field in FIELDS
+                if operation.get(field) is not None)
+
+
+def apply_operations(db_session, operations, gplus_id):
+    """Applies a list of operations in the session, without commiting it.
+
+    Items can only be modified or deleted by the user that created them, like
+    in the per-item controllers.
+
+    Args:
+        db_session: The database session.
+        operations: List of operations, as sent to the API.
+        gplus_id: Id of the user that sends the operations.
+
+    Returns:
+        A tuple with the list of results, in the order of the operations, and
+        the set of tags of the cached pages that changed.
+    """
+    categories = database.Category.__table__
+    items = database.Item.__table__
+    results = [None] * len(operations)
+    for index, operation in enumerate(operations):
+        message = _check(operation)
+        if message is not None:
+            results[index] = _error(400, message)
+    valid = [(index, operation) for index, operation in enumerate(operations)
+             if results[index] is None]
+
+    names = set(operation['category'] for _, operation in valid
+                if operation.get('category'))
+    category_ids = {}
+    if names:
+        category_ids = dict(db_session.execute(
+            sqla.select([categories.c.name, categories.c.id]).where(
+                categories.c.name.in_(names)
+            )
+        ).fetchall())
+    item_ids = set(operation['id'] for _, operation in valid
+                   if operation['action'] != 'create')
+    existing = {}
+    if item_ids:
+        existing = dict((row.id, row) for row in db_session.execute(
+            sqla.select([
+                items.c.id, items.c.gplus_id, items.c.image,
+                categories.c.name.label('category_name')
+            ]).select_from(items.join(categories)).where(
+                items.c.id.in_(item_ids)
+            )
+        ))
+
+    inserts = []
+    # The updates of each item are merged, so every item gets one row.
+    updates = collections.OrderedDict()
+    deleted = set()
+    tags = set()
+    for index, operation in valid:
+        action = operation['action']
+        category = operation.get('category')
+        if category and category not in category_ids:
+            results[index] = _error(404, 'unknown category: %s' % category)
+            continue
+        values = _values(operation)
+        if category:
+            values['category_id'] = category_ids[category]
+            tags.add('category:%s' % category)
+        if action == 'create':
+            values['gplus_id'] = gplus_id
+            inserts.append((index, values))
+            tags.add('recent')
+            continue
+
+        item_id = operation['id']
+        row = existing.get(item_id)
+        if row is None or item_id in deleted:
+            results[index] = _error(404, 'unknown item: %d' % item_id)
+            continue
+        if gplus_id != row.gplus_id:
+            results[index] = _error(403, 'the item belongs to another user')
+            continue
+        tags.update(['recent', 'category:%s' % row.category_name,
+                     'item:%d' % item_id])
+        if action == 'update':
+            updates.setdefault(item_id, {}).update(values)
+        else:
+            updates.pop(item_id, None)
+            deleted.add(item_id)
+        results[index] = {'status': 200, 'id': item_id}
+
+    # Each insert is its own statement, since its id is returned.
+    for index, values in inserts:
+        result = db_session.execute(items.insert().values(**values))
+        results[index] = {'status': 201,
+                          'id': result.inserted_primary_key[0]}
+    # Updates are grouped by the columns they set, since executemany sends
+    # the same columns for every row.
+    groups = collections.defaultdict(list)
+    for item_id, values in updates.items():
+        if values:
+            groups[tuple(sorted(values))].append(dict(values,
+                                                      item_id=item_id))
+    for rows in groups.values():
+        db_session.execute(items.update().where(
+            items.c.id == sqla.bindparam('item_id')
+        ), rows)
+    if deleted:
+        for item_id in deleted:
+            if existing[item_id].image:
+                file_upload.delete_upload(db_session, existing[item_id].image)
+        db_session.execute(items.delete().where(items.c.id.in_(deleted)))
+    return results, tags
+
+
+def load_controllers(app, csrf):
+    """Defines the controllers of the batch API."""
+
+    # Forms can't send JSON, and other origins can't send it without
+    # permission, so the API doesn't need the CSRF token.
+    @csrf.exempt
+    @app.route('/api/items/batch', methods=['POST'])
+    def batch_items():
+        """Applies the operations of the request in one transaction.
+
+        You can only use the API if you are logged.
+
+        Returns:
+            A JSON object with the list of results.
+        """
+        if not flask.session.get('credentials'):
+            flask.abort(403)
+        if 'gplus_id' not in flask.session:
+            flask.abort(401)
+        payload = flask.request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            flask.abort(400)
+        operations = payload.get('operations')
+        if not isinstance(operations, list):
+            flask.abort(400)
+        if len(operations) > config.BATCH_MAX_OPERATIONS:
+            flask.abort(413)
+
+        db_session = database.get_session()
+        results, tags = apply_operations(db_session, operations,
+                                         flask.session['gplus_id'])
+        if tags:
+            conditional.catalog_changed(db_session)
+            # The recent items are reloaded on the next request.
+            recent_items.changed(db_session)
+            page_cache.invalidate(db_session, *tags)
+            db_session.commit()
+        return flask.jsonify(results=results)
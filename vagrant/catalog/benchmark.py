@@ -0,0 +1,227 @@
+# coding: utf-8
+"""Benchmark of the application routes on a synthetic catalog.
+
+A temporary database is filled with synthetic.py, and every route is
+requested with the flask test client. For each route the latency
+percentiles, the queries by request and the growth of the peak memory of
+the process are saved to a JSON file. When a baseline file is given, the
+results are compared with it and the command fails if a route got slower.
+
+Usage:
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json --threshold 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import bulk
+import config
+import database
+import synthetic
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of a sorted list."""
+    index = max(0, int(round(fraction * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def _peak_memory():
+    """Returns the peak resident memory of the process, in kilobytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+
+def _routes(db_session, seed):
+    """Returns the (name, urls) of the benchmarked routes.
+
+    The pages of categories and items are taken at random from the catalog,
+    so the requests don't always hit the same page.
+    """
+    generator = random.Random(seed)
+    categories = [name for name, in db_session.query(database.Category.name)]
+    item_pages = db_session.query(
+        database.Category.name, database.Item.id
+    ).join(database.Item.category).all()
+    generator.shuffle(categories)
+    generator.shuffle(item_pages)
+    return [
+        ('home', ['/']),
+        ('category', ['/catalog/%s' % name for name in categories]),
+        ('item', ['/catalog/%s/%d' % page for page in item_pages[:200]]),
+        ('catalog_json', ['/catalog.json']),
+        ('feed', ['/feed.atom']),
+        ('search', ['/search.json?q=%s' % word for word in synthetic.WORDS]),
+    ]
+
+
+def measure(client, urls, requests):
+    """Requests the urls in turn and measures them.
+
+    Args:
+        client: The flask test client.
+        urls: List of urls of the route.
+        requests: Number of requests.
+
+    Returns:
+        A dictionary with the statistics of the route.
+    """
+    client.get(urls[0]).data
+    latencies = []
+    queries = []
+    memory = _peak_memory()
+    for index in xrange(requests):
+        url = urls[index % len(urls)]
+        with database.count_queries() as statements:
+            start = timeit.default_timer()
+            response = client.get(url)
+            response.data
+            latencies.append((timeit.default_timer() - start) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError('%s returned %d' % (url, response.status_code))
+        queries.append(len(statements))
+    latencies.sort()
+    return {
+        'requests': requests,
+        'mean_ms': sum(latencies) / len(latencies),
+        'p50_ms': percentile(latencies, 0.5),
+        'p90_ms': percentile(latencies, 0.9),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': latencies[-1],
+        'queries_mean': float(sum(queries)) / len(queries),
+        'queries_max': max(queries),
+        'peak_memory_growth_kb': _peak_memory() - memory,
+    }
+
+
+def run(options):
+    """Builds the synthetic catalog and benchmarks every route.
+
+    Returns:
+        The results, that can be saved as JSON.
+    """
+    folder = tempfile.mkdtemp()
+    config.DATABASE_URL = options.database_url or 'sqlite:///%s' % (
+        os.path.join(folder, 'bench.sqlite')
+    )
+    config.PAGE_CACHE_ENABLED = options.page_cache
+    try:
+        database.create_database()
+        start = time.time()
+        bulk.import_items(synthetic.generate(options.categories,
+                                             options.items,
+                                             options.image_ratio,
+                                             options.seed))
+        generation = time.time() - start
+
+        # The application connects to the database when it is imported.
+        import application
+        client = application.app.test_client()
+        with application.app.app_context():
+            routes = _routes(database.get_session(), options.seed)
+        results = {}
+        for name, urls in routes:
+            results[name] = measure(client, urls, options.requests)
+            sys.stderr.write('%-13s p50 %7.2f ms  p90 %7.2f ms  '
+                             '%.1f queries\n' % (
+                                 name, results[name]['p50_ms'],
+                                 results[name]['p90_ms'],
+                                 results[name]['queries_mean']))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'categories': options.categories,
+            'items': options.items,
+            'image_ratio': options.image_ratio,
+            'seed': options.seed,
+            'requests': options.requests,
+            'page_cache': options.page_cache,
+            'database': database.get_engine().dialect.name,
+            'generation_seconds': generation,
+            'peak_memory_kb': _peak_memory(),
+        },
+        'routes': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Compares the results with a baseline.
+
+    Args:
+        results: Results of run().
+        baseline: Results of a previous run.
+        threshold: Fraction of the baseline latency that a route can grow.
+
+    Returns:
+        The names of the routes that regressed.
+    """
+    regressions = []
+    for key in ('categories', 'items', 'image_ratio', 'requests',
+                'page_cache', 'database'):
+        if results['meta'][key] != baseline['meta'].get(key):
+            print 'Warning: the baseline has a different %s.' % key
+    print '%-13s %10s %10s %8s %8s' % ('route', 'base p90', 'p90', 'change',
+                                       'queries')
+    for name, current in sorted(results['routes'].items()):
+        previous = baseline['routes'].get(name)
+        if previous is None:
+            continue
+        change = current['p90_ms'] / max(previous['p90_ms'], 1e-6) - 1
+        slower = change > threshold
+        more_queries = current['queries_max'] > previous['queries_max']
+        print '%-13s %10.2f %10.2f %+7.0f%% %3d->%-3d%s' % (
+            name, previous['p90_ms'], current['p90_ms'], change * 100,
+            previous['queries_max'], current['queries_max'],
+            ' REGRESSION' if slower or more_queries else ''
+        )
+        if slower or more_queries:
+            regressions.append(name)
+    return regressions
+
+
+def main(arguments):
+    """Runs the benchmark from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    synthetic.add_arguments(parser)
+    parser.add_argument('--requests', type=int, default=100,
+                        help='requests to each route')
+    parser.add_argument('--no-page-cache', dest='page_cache',
+                        action='store_false',
+                        help='render every page, even for anonymous users')
+    parser.add_argument('--database-url',
+                        help='empty database used instead of a temporary '
+                        'sqlite file')
+    parser.add_argument('--output', help='file where the results are saved')
+    parser.add_argument('--baseline', help='results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed growth of the p90 latency')
+    options = parser.parse_args(arguments)
+
+    results = run(options)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, options.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,361 @@
+# coding: utf-8
+"""Bulk import and export of the catalog items.
+
+The items are read and written one at a time, in NDJSON (one JSON object per
+line) or CSV, so the memory used does not grow with the size of the catalog.
+Every record has the fields of EXPORT_FIELDS. On import only the name and the
+category are required, the missing categories are created, and an item with
+the same name in the same category is updated instead of inserted.
+
+Usage:
+    python bulk.py import items.ndjson [--batch-size N]
+    python bulk.py export items.csv
+    python bulk.py export - --format ndjson
+"""
+
+import argparse
+import collections
+import csv
+import datetime
+import itertools
+import json
+import sys
+import time
+
+import sqlalchemy as sqla
+
+import category_cache
+import conditional
+import database
+import page_cache
+import recent_items
+
+EXPORT_FIELDS = ['category', 'name', 'description', 'image', 'thumbnail',
+                 'detail_image', 'gplus_id', 'datetime']
+
+# Item columns that can be imported, with the values of the new items that
+# don't have them.
+ITEM_DEFAULTS = {
+    'name': None,
+    'description': '',
+    'image': None,
+    'thumbnail': None,
+    'detail_image': None,
+    'gplus_id': None,
+    'datetime': None,
+}
+
+DATETIME_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                    '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S']
+
+# Rows sent to the database with each executemany, in its own transaction.
+DEFAULT_BATCH_SIZE = 1000
+
+
+def _parse_datetime(value):
+    """Reads a date in ISO 8601 format.
+
+    Raises:
+        ValueError: The date has an unknown format.
+    """
+    for date_format in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('unknown date format: %s' % value)
+
+
+def read_records(stream, file_format):
+    """Reads the records of a file, one at a time.
+
+    Args:
+        stream: The open file.
+        file_format: 'ndjson' or 'csv'.
+
+    Yields:
+        A dictionary for each record.
+    """
+    if file_format == 'csv':
+        # Empty cells are left out, like the missing keys of NDJSON, so they
+        # keep the defaults and the values of the existing items.
+        for row in csv.DictReader(stream):
+            yield dict((key, value.decode('utf-8'))
+                       for key, value in row.items() if value)
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_records(stream, file_format, records):
+    """Writes records to a file, one at a time.
+
+    Args:
+        stream: The open file.
+        file_format: 'ndjson' or 'csv'.
+        records: Iterable of dictionaries with the EXPORT_FIELDS.
+
+    Returns:
+        The number of records written.
+    """
+    count = 0
+    if file_format == 'csv':
+        writer = csv.DictWriter(stream, EXPORT_FIELDS)
+        writer.writeheader()
+    for record in records:
+        if file_format == 'csv':
+            writer.writerow(dict(
+                (key, value.encode('utf-8') if value else value)
+                for key, value in record.items()
+            ))
+        else:
+            stream.write(json.dumps(record))
+            stream.write('\n')
+        count += 1
+    return count
+
+
+def _item_values(record):
+    """Converts a record to the values of the item columns that it has.
+
+    Raises:
+        ValueError: The record has no name or category, a category name that
+            can't be used in the urls, or a wrong date.
+    """
+    if not record.get('name') or not record.get('category'):
+        raise ValueError('records need a name and a category: %r' % record)
+    if not database.valid_category_name(record['category']):
+        raise ValueError('the category name can not be used in the urls: %r'
+                         % record)
+    values = dict((field, record[field]) for field in ITEM_DEFAULTS
+                  if field in record)
+    if values.get('datetime'):
+        values['datetime'] = _parse_datetime(values['datetime'])
+    else:
+        values.pop('datetime', None)
+    return values
+
+
+def _resolve_categories(connection, names, known):
+    """Finds the ids of the categories, creating the missing ones.
+
+    Args:
+        connection: Connection with an open transaction.
+        names: Set of category names.
+        known: Dictionary from names to ids, updated with the new names.
+    """
+    categories = database.Category.__table__
+    missing = [name for name in names if name not in known]
+    if not missing:
+        return
+    query = sqla.select([categories.c.name, categories.c.id])
+    known.update(connection.execute(
+        query.where(categories.c.name.in_(missing))
+    ).fetchall())
+    missing = [name for name in missing if name not in known]
+    if missing:
+        connection.execute(categories.insert(),
+                           [dict(name=name) for name in missing])
+        known.update(connection.execute(
+            query.where(categories.c.name.in_(missing))
+        ).fetchall())
+
+
+def _import_batch(connection, records, categories):
+    """Inserts or updates a batch of items with executemany.
+
+    Args:
+        connection: Connection with an open transaction.
+        records: List of records.
+        categories: Dictionary from category names to ids.
+
+    Returns:
+        A tuple with the number of inserted and updated items.
+    """
+    items = database.Item.__table__
+    _resolve_categories(connection,
+                        set(record['category'] for record in records
+                            if record.get('category')),
+                        categories)
+    # Items are identified by their category and name. If the batch has the
+    # same item twice, the last record wins.
+    batch = collections.OrderedDict()
+    for record in records:
+        values = _item_values(record)
+        values['category_id'] = categories[record['category']]
+        key = (values['category_id'], values['name'])
+        batch.pop(key, None)
+        batch[key] = values
+
+    rows = connection.execute(sqla.select(
+        [items.c.id, items.c.category_id, items.c.name]
+    ).where(sqla.and_(
+        items.c.category_id.in_(set(key[0] for key in batch)),
+        items.c.name.in_(set(key[1] for key in batch))
+    )).order_by(items.c.id.desc()))
+    # When there are repeated items in the database, the oldest is updated.
+    existing = dict(((category_id, name), item_id)
+                    for item_id, category_id, name in rows)
+
+    inserts = []
+    # Updates grouped by the columns they set, since executemany sends the
+    # same columns for every row.
+    updates = collections.defaultdict(list)
+    now = datetime.datetime.utcnow()
+    for key, values in batch.items():
+        if key in existing:
+            values['item_id'] = existing[key]
+            updates[tuple(sorted(values))].append(values)
+        else:
+            row = dict(ITEM_DEFAULTS, datetime=now)
+            row.update(values)
+            inserts.append(row)
+    if inserts:
+        connection.execute(items.insert(), inserts)
+    for rows in updates.values():
+        connection.execute(items.update().where(
+            items.c.id == sqla.bindparam('item_id')
+        ), rows)
+    return len(inserts), sum(len(rows) for rows in updates.values())
+
+
+def _batches(records, size):
+    """Splits the records in lists of the given size."""
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_items(records, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """Imports items in batches, each one in its own transaction.
+
+    When the import ends, even if it stops on a wrong record, the caches of
+    the running processes are invalidated, so they see the batches that were
+    imported.
+
+    Args:
+        records: Iterable of records.
+        batch_size: Number of items of each batch.
+        progress: Function called after each batch with the statistics.
+
+    Returns:
+        A dictionary with the number of inserted and updated items, and the
+        elapsed seconds.
+    """
+    start = time.time()
+    stats = dict(inserted=0, updated=0)
+    categories = {}
+    engine = database.get_engine()
+    try:
+        for batch in _batches(records, batch_size):
+            with engine.begin() as connection:
+                inserted, updated = _import_batch(connection, batch,
+                                                  categories)
+            stats['inserted'] += inserted
+            stats['updated'] += updated
+            stats['seconds'] = time.time() - start
+            if progress is not None:
+                progress(stats)
+    finally:
+        _imported(engine)
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def _imported(engine):
+    """Recounts the uploads and invalidates the caches after an import."""
+    with engine.begin() as connection:
+        database.recount_uploads(connection)
+    db_session = database.get_session()
+    try:
+        category_cache.invalidate(db_session)
+        conditional.catalog_changed(db_session)
+        recent_items.changed(db_session)
+        page_cache.clear(db_session)
+        db_session.commit()
+    finally:
+        database.remove_session()
+
+
+def export_items():
+    """Reads all the items from a server side cursor.
+
+    Yields:
+        A record for each item, sorted by category and id.
+    """
+    categories = database.Category.__table__
+    items = database.Item.__table__
+    query = sqla.select([
+        categories.c.name.label('category'), items.c.name,
+        items.c.description, items.c.image, items.c.thumbnail,
+        items.c.detail_image, items.c.gplus_id, items.c.datetime
+    ]).select_from(items.join(categories)).order_by(
+        categories.c.id, items.c.id
+    )
+    with database.get_engine().connect() as connection:
+        rows = connection.execution_options(stream_results=True).execute(
+            query
+        )
+        for row in rows:
+            record = dict(row)
+            if record['datetime'] is not None:
+                record['datetime'] = record['datetime'].isoformat()
+            yield record
+
+
+def _rate(stats):
+    """Returns the items processed per second."""
+    return ((stats.get('inserted', 0) + stats.get('updated', 0) +
+             stats.get('exported', 0)) / max(stats['seconds'], 1e-6))
+
+
+def _report(stats):
+    """Prints the progress of an import."""
+    sys.stderr.write('%d inserted, %d updated, %.0f rows/s\n' %
+                     (stats['inserted'], stats['updated'], _rate(stats)))
+
+
+def main(arguments):
+    """Runs the command line interface."""
+    parser = argparse.ArgumentParser(description='Import or export items.')
+    parser.add_argument('command', choices=['import', 'export'])
+    parser.add_argument('path', help='file name, or - for stdin/stdout')
+    parser.add_argument('--format', choices=['ndjson', 'csv'],
+                        help='by default, taken from the file extension')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    options = parser.parse_args(arguments)
+    file_format = options.format or (
+        'csv' if options.path.endswith('.csv') else 'ndjson'
+    )
+
+    if options.command == 'import':
+        stream = sys.stdin if options.path == '-' else open(options.path, 'rb')
+        with stream:
+            try:
+                stats = import_items(read_records(stream, file_format),
+                                     options.batch_size, _report)
+            except ValueError as error:
+                # The batches before the wrong record are already imported.
+                sys.stderr.write('Import stopped: %s\n' % error)
+                sys.exit(1)
+        print ('Imported %d items (%d inserted, %d updated) in %.2f seconds, '
+               '%.0f rows/s.' % (stats['inserted'] + stats['updated'],
+                                 stats['inserted'], stats['updated'],
+                                 stats['seconds'], _rate(stats)))
+    else:
+        start = time.time()
+        stream = sys.stdout if options.path == '-' else open(options.path,
+                                                             'wb')
+        with stream:
+            count = write_records(stream, file_format, export_items())
+        stats = dict(exported=count, seconds=time.time() - start)
+        sys.stderr.write('Exported %d items in %.2f seconds, %.0f rows/s.\n'
+                         % (count, stats['seconds'], _rate(stats)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
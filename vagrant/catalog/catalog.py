@@ -6,9 +6,16 @@ import random
 import string
 
 import flask
+import sqlalchemy as sqla
 
+import category_cache
+import conditional
 import database
 import file_upload
+import page_cache
+import recent_items
+import static_files
+import thumbnails
 
 def prepare_login():
     """Configures the state needed for login."""
@@ -28,11 +35,20 @@ def load_controllers(app):
 
     @app.route('/css/main.css')
     def load_css():
-        """Loads the system css."""
-        return flask.send_from_directory('css', 'main.css')
+        """Loads the system css.
+
+        The pages link the css with its fingerprint in the v argument. Those
+        urls change with the css, so they are sent with a long expiration.
+        """
+        version = flask.request.args.get('v')
+        return static_files.send_file(
+            'css', 'main.css',
+            immutable=version == static_files.fingerprint('css/main.css')
+        )
 
     @app.route('/')
     @app.route('/catalog')
+    @page_cache.cached('recent', before=prepare_login)
     def show_catalog():
         """Returns the html with the full catalog sorted in categories.
 
@@ -42,13 +58,11 @@ def load_controllers(app):
         Returns:
             Html template with the list of categories.
         """
-        db_session = database.get_session()
+        db_session = database.get_read_session()
         prepare_login()
-        categories = db_session.query(database.Category).all()
+        categories = category_cache.get_categories(db_session)
 
-        last_items = db_session.query(database.Item).order_by(
-            database.Item.datetime.desc()
-        ).limit(8).all()
+        last_items = recent_items.get_items(db_session, 8)
 
         return flask.render_template('recent.html', categories=categories,
                                      items=last_items)
@@ -75,14 +89,21 @@ def load_controllers(app):
         if flask.request.method == 'GET':
             return flask.render_template('new_category.html')
         elif flask.request.method == 'POST':
-            try:
-                category = database.Category(
-                    name=flask.request.form['name']
-                )
-            except KeyError:
+            name = flask.request.form.get('name')
+            if not database.valid_category_name(name):
                 flask.abort(400)
+            category = database.Category(name=name)
             db_session.add(category)
-            db_session.commit()
+            try:
+                category_cache.invalidate(db_session)
+                conditional.catalog_changed(db_session)
+                recent_items.changed(db_session)
+                page_cache.clear(db_session)
+                db_session.commit()
+            except sqla.exc.IntegrityError:
+                # Category names are unique.
+                db_session.rollback()
+                flask.abort(400)
             return flask.redirect(flask.url_for('show_catalog'))
 
     @app.route('/categories/<int:category_id>/edit', methods=['GET', 'POST'])
@@ -114,11 +135,19 @@ def load_controllers(app):
             return flask.render_template('edit_category.html',
                                          category=category)
         elif flask.request.method == 'POST':
+            name = flask.request.form.get('name')
+            if not database.valid_category_name(name):
+                flask.abort(400)
+            category.name = name
             try:
-                category.name = flask.request.form['name']
-            except KeyError:
+                category_cache.invalidate(db_session)
+                conditional.catalog_changed(db_session)
+                recent_items.changed(db_session)
+                page_cache.clear(db_session)
+                db_session.commit()
+            except sqla.exc.IntegrityError:
+                db_session.rollback()
                 flask.abort(400)
-            db_session.commit()
             return flask.redirect(flask.url_for('show_catalog'))
 
     @app.route('/categories/<int:category_id>/delete', methods=['GET', 'POST'])
@@ -151,35 +180,65 @@ def load_controllers(app):
             return flask.render_template('delete_category.html',
                                          category=category)
         elif flask.request.method == 'POST':
-            if not category.items:
+            if category.items.first() is None:
                 db_session.delete(category)
+                category_cache.invalidate(db_session)
+                conditional.catalog_changed(db_session)
+                recent_items.changed(db_session)
+                page_cache.clear(db_session)
                 db_session.commit()
                 return flask.redirect(flask.url_for('show_catalog'))
             else:
                 flask.abort(500)
 
     @app.route('/catalog/<string:category_name>')
+    @page_cache.cached('category:{category_name}', before=prepare_login)
     def show_category_items(category_name):
         """Returns the item list for a specific category.
 
+        The list is split in pages. The after and before arguments of the
+        query string contain the id of the item next to the page.
+
         Args:
             category_name: The name of the category that is being listed.
 
         Returns:
             Html template with the list of items.
         """
-        db_session = database.get_session()
+        db_session = database.get_read_session()
         prepare_login()
-        categories = db_session.query(database.Category).all()
+        categories = category_cache.get_categories(db_session)
         category = db_session.query(database.Category).filter(
             database.Category.name == category_name
         ).one()
-
-        return flask.render_template('catalog.html', category=category,
-                                     categories=categories,
-                                     catalog=category.items)
+        count, last_modified = conditional.category_stamp(db_session,
+                                                          category)
+        etag = conditional.page_etag(flask.request.full_path, category.id,
+                                     count, last_modified,
+                                     category_cache.version())
+        # The date doesn't cover the categories and the session, so
+        # If-Modified-Since is not answered.
+        response = conditional.not_modified(etag)
+        if response is not None:
+            return response
+
+        items, previous, following = database.page_items(
+            db_session, category,
+            after=flask.request.args.get('after', type=int),
+            before=flask.request.args.get('before', type=int)
+        )
+
+        return conditional.add_validators(
+            flask.render_template('catalog.html', category=category,
+                                  categories=categories,
+                                  catalog=items,
+                                  previous=previous,
+                                  following=following),
+            etag, last_modified
+        )
 
     @app.route('/catalog/<string:category_name>/<int:item_id>')
+    @page_cache.cached('item:{item_id}', before=prepare_login)
     def show_catalog_item(category_name, item_id):
         """Returns the html for a specific item in the catalog.
 
@@ -193,15 +252,28 @@ def load_controllers(app):
         Returns:
             Html with the item information.
         """
-        db_session = database.get_session()
+        db_session = database.get_read_session()
         prepare_login()
-        categories = db_session.query(database.Category).all()
-        item = db_session.query(database.Item).get(item_id)
+        categories = category_cache.get_categories(db_session)
+        item = db_session.query(database.Item).options(
+            database.with_category()
+        ).get(item_id)
         if item is not None:
-            return flask.render_template('item.html',
-                                         category_name=category_name,
-                                         categories=categories,
-                                         item=item)
+            last_modified = conditional.item_stamp(item)
+            etag = conditional.page_etag(flask.request.full_path, item.id,
+                                         item.category_id, last_modified,
+                                         category_cache.version())
+            # Like the category page, only the ETag is checked.
+            response = conditional.not_modified(etag)
+            if response is not None:
+                return response
+            return conditional.add_validators(
+                flask.render_template('item.html',
+                                      category_name=category_name,
+                                      categories=categories,
+                                      item=item),
+                etag, last_modified
+            )
         else:
             flask.abort(404)
 
@@ -230,12 +302,11 @@ def load_controllers(app):
         db_session = database.get_session()
         prepare_login()
         if flask.request.method == 'GET':
-            categories = db_session.query(database.Category).all()
+            categories = category_cache.get_categories(db_session)
             return flask.render_template('new_item.html',
                                          categories=categories,
                                          category_name=category_name)
         elif flask.request.method == 'POST':
-            categories = db_session.query(database.Category).all()
             category = db_session.query(database.Category).filter(
                 database.Category.name == category_name
             ).one()
@@ -243,14 +314,20 @@ def load_controllers(app):
                 item = database.Item(
                     name=flask.request.form['name'],
                     description=flask.request.form['description'],
-                    image=file_upload.save_upload(),
+                    image=file_upload.save_upload(db_session),
                     gplus_id=flask.session['gplus_id'],
                     category_id=category.id
                 )
             except KeyError:
                 flask.abort(401)
             db_session.add(item)
+            conditional.catalog_changed(db_session)
+            version = recent_items.changed(db_session)
+            page_cache.invalidate(db_session, 'recent',
+                                  'category:%s' % category.name)
             db_session.commit()
+            recent_items.item_saved(item, version)
+            thumbnails.schedule(item.image)
             return flask.redirect(flask.url_for('show_category_items',
                                                 category_name=category_name))
 
@@ -286,7 +363,7 @@ def load_controllers(app):
         if flask.request.method == 'GET':
             try:
                 if (flask.session['gplus_id'] == item.gplus_id):
-                    categories = db_session.query(database.Category).all()
+                    categories = category_cache.get_categories(db_session)
                     return flask.render_template('edit_item.html',
                                                  category_name=category_name,
                                                  categories=categories,
@@ -300,16 +377,25 @@ def load_controllers(app):
                 if (flask.session['gplus_id'] == item.gplus_id):
                     item.name = flask.request.form['name']
                     item.description = flask.request.form['description']
-                    filename = file_upload.save_upload()
+                    filename = file_upload.save_upload(db_session)
                     if filename:
                         if item.image:
-                            file_upload.delete_upload(item.image)
+                            file_upload.delete_upload(db_session, item.image)
                         item.image = filename
+                        item.thumbnail = None
+                        item.detail_image = None
                 else:
                     flask.abort(403)
             except KeyError:
                 flask.abort(401)
+            pages = page_cache.item_tags(item)
+            conditional.catalog_changed(db_session)
+            version = recent_items.changed(db_session)
+            page_cache.invalidate(db_session, *pages)
             db_session.commit()
+            recent_items.item_saved(item, version)
+            if filename:
+                thumbnails.schedule(filename)
             return flask.redirect(flask.url_for('show_catalog_item',
                                                 category_name=category_name,
                                                 item_id=item_id))
@@ -347,7 +433,7 @@ def load_controllers(app):
         if flask.request.method == 'GET':
             try:
                 if (flask.session['gplus_id'] == item.gplus_id):
-                    categories = db_session.query(database.Category).all()
+                    categories = category_cache.get_categories(db_session)
                     return flask.render_template('delete_item.html',
                                                  category_name=category_name,
                                                  categories=categories,
@@ -360,12 +446,17 @@ def load_controllers(app):
             try:
                 if (flask.session['gplus_id'] == item.gplus_id):
                     if item.image:
-                        file_upload.delete_upload(item.image)
+                        file_upload.delete_upload(db_session, item.image)
                     db_session.delete(item)
                 else:
                     flask.abort(403)
             except KeyError:
                 flask.abort(401)
+            pages = page_cache.item_tags(item)
+            conditional.catalog_changed(db_session)
+            version = recent_items.changed(db_session)
+            page_cache.invalidate(db_session, *pages)
             db_session.commit()
+            recent_items.item_deleted(item_id, version)
             return flask.redirect(flask.url_for('show_category_items',
                                                 category_name=category_name))
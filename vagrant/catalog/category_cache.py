@@ -0,0 +1,62 @@
+# coding: utf-8
+"""In-process cache of the categories shown in the navigation bar.
+
+The list is loaded once and shared by all the requests of the process. The
+category controllers bump the 'categories' version counter when they modify
+a category, and every process reloads its list when it sees a new value, so
+all the workers stay consistent.
+"""
+
+import collections
+import threading
+
+import database
+
+VERSION = 'categories'
+
+CachedCategory = collections.namedtuple('CachedCategory', ['id', 'name'])
+
+_lock = threading.Lock()
+_version = None
+_categories = []
+
+
+def get_categories(db_session):
+    """Returns the list of categories.
+
+    Only checks the version counter, unless the categories were modified
+    since the list was loaded.
+
+    Args:
+        db_session: The database session.
+
+    Returns:
+        A list of CachedCategory with the id and name of every category.
+    """
+    global _version, _categories
+    version = database.get_version(db_session, VERSION)
+    if version != _version:
+        rows = db_session.query(
+            database.Category.id, database.Category.name
+        ).order_by(database.Category.id).all()
+        with _lock:
+            _categories = [CachedCategory(*row) for row in rows]
+            _version = version
+    return _categories
+
+
+def version():
+    """Returns the version of the loaded categories."""
+    return _version
+
+
+def invalidate(db_session):
+    """Marks the categories as modified.
+
+    Must be called before commiting the session that modifies them, so the
+    change and the new version are saved together.
+
+    Args:
+        db_session: The database session.
+    """
+    database.bump_version(db_session, VERSION)
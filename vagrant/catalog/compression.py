@@ -0,0 +1,198 @@
+# coding: utf-8
+"""Compression of the responses, as a WSGI middleware.
+
+The text responses are compressed with gzip, or with brotli when the client
+accepts it and the brotli package is installed. Responses without a length,
+like the streamed JSON catalog, are compressed while they are sent.
+
+The compressed bodies of the responses with an ETag are kept in memory, keyed
+by the ETag and the encoding, so a page or a static file that didn't change
+is not compressed again. The compressed responses get the encoding added to
+their ETag, and it is removed from If-None-Match before the application sees
+it, so the application keeps checking its own ETags.
+"""
+
+import itertools
+import re
+import zlib
+
+from werkzeug import datastructures
+from werkzeug import http
+from werkzeug import wsgi
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import config
+import lru
+
+COMPRESSIBLE_TYPES = set(['application/json', 'application/atom+xml',
+                          'application/javascript', 'application/xml',
+                          'image/svg+xml'])
+
+# Encoding added at the end of the ETags of the compressed responses.
+ETAG_SUFFIX = re.compile(r'-(gzip|br)"')
+
+
+def choose_encoding(accept_encoding):
+    """Returns the preferred encoding that can be used, or None.
+
+    Args:
+        accept_encoding: The Accept-Encoding header of the request.
+    """
+    accepted = http.parse_accept_header(accept_encoding)
+    available = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best = max(available, key=accepted.quality)
+    return best if accepted.quality(best) > 0 else None
+
+
+def is_compressible(headers):
+    """Checks if a response can be compressed, from its headers."""
+    mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+    if not (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES):
+        return False
+    return ('Content-Encoding' not in headers and
+            'X-Sendfile' not in headers and
+            'X-Accel-Redirect' not in headers and
+            'no-transform' not in headers.get('Cache-Control', ''))
+
+
+def compress(data, encoding):
+    """Compresses a whole body."""
+    if encoding == 'br':
+        return brotli.compress(data, quality=config.BROTLI_QUALITY)
+    compressor = zlib.compressobj(config.GZIP_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    """Compresses a body while it is read.
+
+    Every chunk is flushed, so the client receives the data when the
+    application produces it.
+
+    Yields:
+        The compressed chunks.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=config.BROTLI_QUALITY)
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(config.GZIP_LEVEL, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            # zlib keeps small chunks in its buffer until they are flushed.
+            data = (compressor.compress(chunk) +
+                    compressor.flush(zlib.Z_SYNC_FLUSH))
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+def _add_suffix(etag, encoding):
+    """Adds the encoding at the end of an ETag."""
+    if etag.endswith('"'):
+        return '%s-%s"' % (etag[:-1], encoding)
+    return etag
+
+
+class CompressionMiddleware(object):
+    """WSGI middleware that compresses the responses.
+
+    Attributes:
+        app: The wrapped WSGI application.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._bodies = lru.LRUCache(config.COMPRESSION_CACHE_SIZE,
+                                    config.COMPRESSION_CACHE_TTL)
+
+    def __call__(self, environ, start_response):
+        encoding = None
+        if environ['REQUEST_METHOD'] == 'GET':
+            encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING',
+                                                   ''))
+        # The client may have a compressed version of the response.
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        cached_encoding = None
+        if if_none_match:
+            match = ETAG_SUFFIX.search(if_none_match)
+            if match is not None:
+                cached_encoding = match.group(1)
+                environ['HTTP_IF_NONE_MATCH'] = ETAG_SUFFIX.sub(
+                    '"', if_none_match
+                )
+
+        response = []
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, headers, exc_info]
+            return written.append
+
+        body = self.app(environ, capture)
+        status, headers, exc_info = response
+        headers = datastructures.Headers(headers)
+        # Data given to the write callable goes before the body.
+        chunks = itertools.chain(written, body)
+        code = int(status.split(None, 1)[0])
+        compressible = is_compressible(headers)
+        if compressible or (code == 304 and cached_encoding):
+            vary = http.parse_set_header(headers.get('Vary'))
+            vary.add('Accept-Encoding')
+            headers['Vary'] = vary.to_header()
+
+        if code == 304 and cached_encoding and 'ETag' in headers:
+            headers['ETag'] = _add_suffix(headers['ETag'], cached_encoding)
+        length = headers.get('Content-Length', type=int)
+        small = length is not None and length < config.COMPRESSION_MIN_SIZE
+        if code != 200 or encoding is None or not compressible or small:
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return wsgi.ClosingIterator(chunks, getattr(body, 'close', None))
+
+        etag = headers.get('ETag')
+        if etag is not None:
+            headers['ETag'] = _add_suffix(etag, encoding)
+        headers['Content-Encoding'] = encoding
+        # Byte ranges would refer to the compressed body.
+        headers.pop('Accept-Ranges', None)
+        if length is None:
+            headers.pop('Content-Length', None)
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return wsgi.ClosingIterator(compress_stream(chunks, encoding),
+                                        getattr(body, 'close', None))
+
+        key = None
+        cache_control = headers.get('Cache-Control', '')
+        if (etag is not None and 'no-store' not in cache_control and
+                length <= config.COMPRESSION_CACHE_MAX_BODY):
+            key = (environ.get('PATH_INFO'), etag, encoding)
+        data = self._bodies.get(key) if key is not None else None
+        try:
+            if data is None:
+                data = compress(''.join(chunks), encoding)
+                if key is not None:
+                    self._bodies.set(key, data)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        headers['Content-Length'] = str(len(data))
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return [data]
+
+
+def init_app(app):
+    """Compresses the responses of the application.
+
+    Args:
+        app: The flask application.
+    """
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app)
@@ -0,0 +1,151 @@
+# coding: utf-8
+"""Helpers that answer conditional GET requests.
+
+The responses carry an ETag and a Last-Modified header built from stamps
+that are cheap to read from the database. When the client already has the
+current version, the controllers answer 304 without rendering anything.
+
+The JSON and Atom responses only depend on the catalog, so they answer both
+If-None-Match and If-Modified-Since. The html pages also show the categories
+and the login of the session, that change without changing the date of the
+items, so they only answer If-None-Match.
+"""
+
+import hashlib
+
+import flask
+import sqlalchemy as sqla
+
+import database
+
+
+def catalog_changed(db_session):
+    """Marks the catalog as modified.
+
+    Must be called before commiting the session that modifies an item or a
+    category, so the change and the new stamp are saved together.
+
+    Args:
+        db_session: The database session.
+    """
+    database.bump_version(db_session, database.CATALOG_VERSION)
+
+
+def catalog_stamp(db_session):
+    """Returns the stamp of the whole catalog.
+
+    Args:
+        db_session: The database session.
+
+    Returns:
+        A tuple with the version of the catalog and the date of its last
+        modification.
+    """
+    row = db_session.query(
+        database.Version.value, database.Version.updated
+    ).filter(database.Version.name == database.CATALOG_VERSION).first()
+    if row is None:
+        return 0, None
+    return row.value, row.updated
+
+
+def category_stamp(db_session, category):
+    """Returns the stamp of the items of a category.
+
+    Args:
+        db_session: The database session.
+        category: The category.
+
+    Returns:
+        A tuple with the number of items, and the date of the most recent
+        change to one of them.
+    """
+    # The type is lost by the aggregate, and sqlite would return a string.
+    last_modified = sqla.type_coerce(
+        sqla.func.max(sqla.func.coalesce(database.Item.updated,
+                                         database.Item.datetime)),
+        sqla.DateTime
+    )
+    row = db_session.query(
+        sqla.func.count(database.Item.id), last_modified
+    ).filter(database.Item.category_id == category.id).one()
+    return row[0], row[1]
+
+
+def item_stamp(item):
+    """Returns the date of the last change to an item."""
+    return item.updated or item.datetime
+
+
+def session_fingerprint():
+    """Returns the values of the session that change the rendered pages."""
+    return (flask.session.get('state'),
+            bool(flask.session.get('credentials')),
+            flask.session.get('gplus_id'),
+            flask.session.get('username'))
+
+
+def make_etag(*parts):
+    """Builds a strong ETag from the values that identify a response."""
+    key = u'|'.join(unicode(part) for part in parts)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def page_etag(*parts):
+    """Builds the ETag of an html page.
+
+    Pages show the login information, so the ETag includes the session. The
+    ETag of the content alone is kept in flask.g.content_etag.
+    """
+    flask.g.content_etag = make_etag(*parts)
+    return session_etag(flask.g.content_etag)
+
+
+def session_etag(content_etag):
+    """Combines the ETag of a page content with the current session."""
+    return make_etag(content_etag, *session_fingerprint())
+
+
+def not_modified(etag, last_modified=None):
+    """Checks if the client already has the current version.
+
+    If-Modified-Since is only used when no ETag was sent and last_modified
+    is given, so pages that depend on more than a date ignore it.
+
+    Args:
+        etag: ETag of the current version.
+        last_modified: Date of the current version.
+
+    Returns:
+        A 304 response if the client version is current, None otherwise.
+    """
+    request = flask.request
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    elif last_modified is not None and request.if_modified_since:
+        fresh = (last_modified.replace(microsecond=0) <=
+                 request.if_modified_since.replace(tzinfo=None))
+    else:
+        fresh = False
+    if not fresh:
+        return None
+    return add_validators(flask.Response(status=304), etag, last_modified)
+
+
+def add_validators(response, etag, last_modified=None):
+    """Adds the ETag and Last-Modified headers to a response.
+
+    Args:
+        response: The flask response, or a value accepted by make_response.
+        etag: ETag of the response.
+        last_modified: Date of the response.
+
+    Returns:
+        The response with the headers.
+    """
+    response = flask.make_response(response)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
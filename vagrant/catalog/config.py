@@ -1,5 +1,119 @@
 # coding: utf-8
 """Defines constants for the application."""
 
+import os
+
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+
+# Database of the catalog. Any SQLAlchemy url works, like
+# postgresql://vagrant@/catalog. By default, an sqlite file next to this one.
+DATABASE_URL = os.environ.get(
+    'CATALOG_DATABASE_URL',
+    'sqlite:///%s' % os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'catalog.sqlite')
+)
+# Read only replica of the database for the controllers that only read, None
+# to read from the primary.
+DATABASE_REPLICA_URL = os.environ.get('CATALOG_DATABASE_REPLICA_URL')
+# Seconds that the reads of a visitor go to the primary after a change, so
+# they see it even if the replica is behind.
+DATABASE_REPLICA_LAG = 10
+# Connections kept open by the pool of each process.
+DATABASE_POOL_SIZE = 5
+# Extra connections allowed when the pool is exhausted.
+DATABASE_MAX_OVERFLOW = 10
+# Seconds after which a pooled connection is recycled.
+DATABASE_POOL_RECYCLE = 3600
+# Seconds to wait for a free connection before failing.
+DATABASE_POOL_TIMEOUT = 30
+# Pragmas applied to every sqlite connection. WAL lets the readers work while
+# a transaction writes.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 64 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
+
+# Number of items shown in each page of a category.
+CATEGORY_PAGE_SIZE = 20
+
+# Cache of the pages shown to anonymous visitors.
+PAGE_CACHE_ENABLED = True
+# Maximum number of pages kept in memory by each process.
+PAGE_CACHE_SIZE = 500
+# Seconds that a page is kept in the cache.
+PAGE_CACHE_TTL = 300
+# Directory shared by all the processes, None to only cache in memory.
+PAGE_CACHE_DIR = None
+
+# Number of items shown in each page of the search results.
+SEARCH_PAGE_SIZE = 20
+
+# Responses smaller than this number of bytes are not compressed.
+COMPRESSION_MIN_SIZE = 500
+# Compression level of gzip, from 1 to 9, and quality of brotli, from 0 to 11.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Number of compressed bodies kept in memory, and seconds they are kept.
+COMPRESSION_CACHE_SIZE = 500
+COMPRESSION_CACHE_TTL = 3600
+# Larger bodies are compressed on every request instead of kept in memory.
+COMPRESSION_CACHE_MAX_BODY = 1024 * 1024
+
+# Maximum number of operations in a request to the batch API.
+BATCH_MAX_OPERATIONS = 1000
+
+# Number of recent items kept in memory, for the home page and the feed.
+RECENT_ITEMS_SIZE = 20
+
+# Maximum sizes of the resized versions of the uploaded images.
+THUMBNAIL_SIZE = (300, 300)
+DETAIL_SIZE = (800, 800)
+# Threads that resize the images in the background.
+THUMBNAIL_WORKERS = 2
+
+# Seconds that browsers keep the files with a fingerprint in their url.
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+# How the front server sends the files: None to send them from python,
+# 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx).
+SENDFILE_MODE = None
+# Internal nginx location of the application folder, for 'x-accel-redirect'.
+ACCEL_REDIRECT_PREFIX = '/protected/'
+
+# Urls of the Google services used by the login. The token url None means
+# the one of client_secrets.json.
+GOOGLE_TOKEN_URL = None
+GOOGLE_TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
+GOOGLE_USERINFO_URL = 'https://www.googleapis.com/oauth2/v1/userinfo'
+GOOGLE_REVOKE_URL = 'https://accounts.google.com/o/oauth2/revoke'
+# Seconds to wait for an answer of Google.
+GOOGLE_HTTP_TIMEOUT = 10
+# Keep-alive connections to Google, and threads that call it, per process.
+GOOGLE_HTTP_POOL_SIZE = 8
+# Access tokens whose information is cached, and for how many seconds.
+GOOGLE_TOKEN_CACHE_SIZE = 1000
+GOOGLE_TOKEN_CACHE_TTL = 60
+
+# Database of the sessions, shared by all the processes.
+SESSION_DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'sessions.sqlite')
+# Seconds that an unused session is kept.
+SESSION_TTL = 7 * 24 * 60 * 60
+# Sessions kept in memory by each process.
+SESSION_MEMORY_SIZE = 10000
+# Fraction of the saved sessions that also delete the expired ones.
+SESSION_SWEEP_PROBABILITY = 0.01
+# Values kept in a signed cookie, instead of the database, while the session
+# has nothing else.
+SESSION_COOKIE_KEYS = frozenset(['_csrf_token', 'state'])
+
+# Folder with the bytecode of the compiled templates, shared by all the
+# processes. None to compile them in every process.
+TEMPLATE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'jinja_cache')
+# Folder of the templates precompiled by template_cache.py build. It is only
+# used while it is newer than the templates.
+TEMPLATE_BUNDLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'compiled_templates')
@@ -1,12 +1,49 @@
 #coding: utf-8
 """Database definition."""
 
+import contextlib
+import datetime
+import sys
+import time
+
+import flask
 import sqlalchemy as sqla
 from sqlalchemy import orm
+from sqlalchemy import pool
 from sqlalchemy.ext import declarative
 
+import config
+
 Base = declarative.declarative_base()
 
+# Full text index of the items, only created on sqlite.
+SEARCH_TABLE = 'catalog_search'
+# Version counter modified by every change to the items or categories. Its
+# date is the Last-Modified of the responses with the whole catalog.
+CATALOG_VERSION = 'catalog'
+
+_engine = None
+_read_engine = None
+_query_counters = []
+
+# Sessions are scoped to the current application context, so every request
+# shares a single session that is removed when the context is torn down.
+Session = orm.scoped_session(orm.sessionmaker(),
+                             scopefunc=flask._app_ctx_stack.__ident_func__)
+# Sessions of the read only controllers, bound to the replica when there is
+# one.
+ReadSession = orm.scoped_session(orm.sessionmaker(),
+                                 scopefunc=flask._app_ctx_stack.__ident_func__)
+
+
+def _now():
+    """Returns the current UTC time.
+
+    Unlike the database clock, it keeps the microseconds, so two changes in
+    the same second get different stamps.
+    """
+    return datetime.datetime.utcnow()
+
 
 class Category(Base):
     """Table that contains the catalog categories.
@@ -15,8 +52,9 @@ class Category(Base):
     __tablename__ = 'categories'
 
     id = sqla.Column(sqla.Integer, primary_key=True)
-    name = sqla.Column(sqla.String(100), nullable=False)
-    items = orm.relationship('Item', backref="category",
+    name = sqla.Column(sqla.String(100), nullable=False, unique=True,
+                       index=True)
+    items = orm.relationship('Item', backref="category", lazy='dynamic',
                              order_by='Item.datetime.desc()')
     gplus_id = sqla.Column(sqla.String)
 
@@ -24,7 +62,7 @@ class Category(Base):
         return {
             'id': self.id,
             'name': self.name,
-            'items': self.items
+            'items': self.items.all()
         }
 
 class Item(Base):
@@ -36,13 +74,21 @@ class Item(Base):
     """
 
     __tablename__ = 'catalog'
+    __table_args__ = (
+        sqla.Index('ix_catalog_datetime', 'datetime'),
+        sqla.Index('ix_catalog_category_id_datetime',
+                   'category_id', 'datetime'),
+    )
 
     id = sqla.Column(sqla.Integer, primary_key=True)
     name = sqla.Column(sqla.String(100), nullable=False)
     description = sqla.Column(sqla.String, default='')
     category_id = sqla.Column(sqla.ForeignKey('categories.id'), nullable=False)
     image = sqla.Column(sqla.String(100))
+    thumbnail = sqla.Column(sqla.String(100))
+    detail_image = sqla.Column(sqla.String(100))
     datetime = sqla.Column(sqla.DateTime, default=sqla.func.now())
+    updated = sqla.Column(sqla.DateTime, default=_now, onupdate=_now)
     gplus_id = sqla.Column(sqla.String)
 
     def get_json(self):
@@ -54,6 +100,167 @@ class Item(Base):
         }
 
 
+def valid_category_name(name):
+    '''Checks that a category name can be used in the urls of the catalog.
+
+    The names with a slash don't match the category routes, and the names
+    ending in .json would be taken by the JSON of the category,
+    /catalog/<name>.json.
+    '''
+    return bool(name) and '/' not in name and not name.endswith('.json')
+
+
+class Version(Base):
+    """Table with counters that change every time some data is modified.
+
+    Each process compares the counters with the ones of its caches to know
+    when they are stale.
+
+    Attributes:
+        name: name of the data that is versioned.
+        value: number of times the data has been modified.
+        updated: when the data was modified for the last time.
+    """
+
+    __tablename__ = 'versions'
+
+    name = sqla.Column(sqla.String(50), primary_key=True)
+    value = sqla.Column(sqla.Integer, nullable=False, default=0)
+    updated = sqla.Column(sqla.DateTime, default=_now)
+
+
+class Upload(Base):
+    """Table that counts the items that use each uploaded file.
+
+    Attributes:
+        filename: name of the file in the uploads folder.
+        refcount: number of items that use the file.
+    """
+
+    __tablename__ = 'uploads'
+
+    filename = sqla.Column(sqla.String(100), primary_key=True)
+    refcount = sqla.Column(sqla.Integer, nullable=False, default=0)
+
+
+class SchemaVersion(Base):
+    """Table that records the migrations applied to the database.
+
+    Attributes:
+        version: number of an applied migration.
+        applied: when the migration was applied.
+    """
+
+    __tablename__ = 'schema_version'
+
+    version = sqla.Column(sqla.Integer, primary_key=True, autoincrement=False)
+    applied = sqla.Column(sqla.DateTime, default=sqla.func.now())
+
+
+# Creates the backrefs, like Item.category, when the module is imported and
+# not on the first query, so they can be used in the queries of a new process.
+orm.configure_mappers()
+
+
+def with_category():
+    """Loading strategy that fetches the category in the same query as the
+    items, so templates can read item.category without extra queries."""
+    return orm.joinedload(Item.category)
+
+
+def page_items(db_session, category, after=None, before=None, size=None):
+    """Returns a page with the items of a category, most recent first.
+
+    Pages are found by the (datetime, id) of the item next to them, so the
+    database reads only the items of the page, even for the last pages.
+
+    Args:
+        db_session: The database session.
+        category: The category of the items.
+        after: Id of the item before the page.
+        before: Id of the item after the page.
+        size: Number of items in the page.
+
+    Returns:
+        A tuple with the items of the page, the id to use as the before
+        argument for the previous page, and the id to use as the after
+        argument for the next page. Ids are None if there is no such page.
+    """
+    size = size or config.CATEGORY_PAGE_SIZE
+    query = category.items
+    cursor = after if after is not None else before
+    if cursor is not None:
+        # Dates are compared inside the database, so they don't go through
+        # the python conversions.
+        last = orm.aliased(Item)
+        last_datetime = db_session.query(last.datetime).filter(
+            last.id == cursor
+        ).as_scalar()
+        if after is not None:
+            query = query.filter(sqla.or_(
+                Item.datetime < last_datetime,
+                sqla.and_(Item.datetime == last_datetime, Item.id < after)
+            ))
+        else:
+            query = query.filter(sqla.or_(
+                Item.datetime > last_datetime,
+                sqla.and_(Item.datetime == last_datetime, Item.id > before)
+            )).order_by(None).order_by(Item.datetime, Item.id)
+
+    if before is None:
+        items = query.order_by(Item.id.desc()).limit(size + 1).all()
+        more = len(items) > size
+        items = items[:size]
+        previous = items[0].id if items and after is not None else None
+        following = items[-1].id if more else None
+    else:
+        items = query.limit(size + 1).all()
+        more = len(items) > size
+        items = list(reversed(items[:size]))
+        previous = items[0].id if more else None
+        following = items[-1].id if items else None
+    return items, previous, following
+
+
+def get_version(db_session, name):
+    """Returns the current value of a version counter.
+
+    Args:
+        db_session: The database session.
+        name: Name of the counter.
+
+    Returns:
+        The value of the counter, 0 if it has never been modified.
+    """
+    value = db_session.query(Version.value).filter(
+        Version.name == name
+    ).scalar()
+    return value or 0
+
+
+def bump_version(db_session, name):
+    """Increments a version counter inside the current transaction.
+
+    The change is only visible for the other processes after the session is
+    commited, and it is discarded if the session is rolled back.
+
+    Args:
+        db_session: The database session.
+        name: Name of the counter.
+
+    Returns:
+        The new value of the counter.
+    """
+    updated = db_session.query(Version).filter(Version.name == name).update(
+        {Version.value: Version.value + 1, Version.updated: _now()},
+        synchronize_session=False
+    )
+    if not updated:
+        db_session.add(Version(name=name, value=1))
+        db_session.flush()
+    return get_version(db_session, name)
+
+
 def parseJSON(o):
     """Parser for database objects.
 
@@ -74,23 +281,394 @@ def parseJSON(o):
         raise TypeError('object is not json serializable')
 
 
-def get_engine():
-    '''Creates the engine that will be used with the database.'''
-    engine = sqla.create_engine('sqlite:///catalog.sqlite')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    '''Applies config.SQLITE_PRAGMAS to a new sqlite connection.'''
+    cursor = dbapi_connection.cursor()
+    for name, value in sorted(config.SQLITE_PRAGMAS.items()):
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+def _create_engine(url):
+    '''Creates an engine with a pool of connections to a database.'''
+    connect_args = {}
+    if url.startswith('sqlite'):
+        # Pooled sqlite connections are shared between request threads.
+        connect_args['check_same_thread'] = False
+    engine = sqla.create_engine(
+        url,
+        poolclass=pool.QueuePool,
+        pool_size=config.DATABASE_POOL_SIZE,
+        max_overflow=config.DATABASE_MAX_OVERFLOW,
+        pool_recycle=config.DATABASE_POOL_RECYCLE,
+        pool_timeout=config.DATABASE_POOL_TIMEOUT,
+        connect_args=connect_args
+    )
+    if engine.dialect.name == 'sqlite':
+        sqla.event.listen(engine, 'connect', _set_sqlite_pragmas)
+    sqla.event.listen(engine, 'before_cursor_execute', _count_statement)
     return engine
 
 
+def get_engine():
+    '''Returns the engine that will be used with the database.
+
+    The engine and its connection pool are created only once per process.
+    '''
+    global _engine
+    if _engine is None:
+        _engine = _create_engine(config.DATABASE_URL)
+        Session.configure(bind=_engine)
+    return _engine
+
+
+def get_read_engine():
+    '''Returns the engine of the replica used by the read only
+    controllers, or the primary engine when there is no replica.'''
+    global _read_engine
+    if _read_engine is None:
+        if config.DATABASE_REPLICA_URL:
+            _read_engine = _create_engine(config.DATABASE_REPLICA_URL)
+        else:
+            _read_engine = get_engine()
+        ReadSession.configure(bind=_read_engine)
+    return _read_engine
+
+
+def dispose_engines():
+    '''Closes the pooled connections of the engines.
+
+    A process must call it before it forks, so its children don't share its
+    connections, and the children call it again to discard anything they
+    inherited. The pools open new connections when they are used.
+    '''
+    for engine in set([_engine, _read_engine]):
+        if engine is not None:
+            engine.dispose()
+
+
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    '''Adds the statement to the active query counters.'''
+    for counter in _query_counters:
+        counter.append(statement)
+
+
+@contextlib.contextmanager
+def count_queries(maximum=None):
+    '''Counts the SQL statements executed inside the block.
+
+    Args:
+        maximum: If given, raise an error when more statements run.
+
+    Yields:
+        The list of statements executed so far.
+
+    Raises:
+        AssertionError: The block executed more than maximum statements.
+    '''
+    get_engine()
+    statements = []
+    _query_counters.append(statements)
+    try:
+        yield statements
+    finally:
+        _query_counters.remove(statements)
+    if maximum is not None and len(statements) > maximum:
+        raise AssertionError('%d queries executed, expected at most %d:\n%s'
+                             % (len(statements), maximum,
+                                '\n'.join(statements)))
+
+
 def get_session():
-    '''Get a database session that will be used to interact with it.'''
-    engine = get_engine()
-    DBSession = orm.sessionmaker(bind=engine)
-    return DBSession()
+    '''Get a database session that will be used to interact with it.
+
+    The session is shared by the current application context, and it is
+    closed when the context is removed.
+    '''
+    get_engine()
+    return Session()
+
+
+def get_read_session():
+    '''Get a database session for the controllers that only read.
+
+    The session reads from the replica, unless the visitor modified the
+    database recently and the replica may not have the change yet.
+    '''
+    if (flask.has_request_context() and
+            flask.session.get('primary_until', 0) > time.time()):
+        return get_session()
+    get_read_engine()
+    return ReadSession()
+
+
+@sqla.event.listens_for(orm.Session, 'after_commit')
+def _read_from_primary(db_session):
+    '''Sends the reads of the visitor to the primary after a change.'''
+    if (config.DATABASE_REPLICA_URL and flask.has_request_context() and
+            db_session.bind is _engine):
+        flask.session['primary_until'] = (time.time() +
+                                          config.DATABASE_REPLICA_LAG)
+
+
+def remove_session(exception=None):
+    '''Closes the sessions of the current context and releases their
+    connections back to the pool.'''
+    Session.remove()
+    ReadSession.remove()
+
+
+def init_app(app):
+    '''Registers the database hooks on the flask application.
+
+    Args:
+        app: The flask application.
+    '''
+    app.teardown_appcontext(remove_session)
 
 
 def create_database():
-    '''Creates all the tables on the database.'''
+    '''Creates all the tables on the database.
+
+    The new database already has the latest schema, so every migration is
+    recorded as applied. A database that already has the items is migrated
+    instead, since its tables may have an older schema.
+
+    Returns:
+        True if the database was created, False if it was migrated.
+    '''
     engine = get_engine()
+    with engine.connect() as connection:
+        existed = engine.dialect.has_table(connection, Item.__tablename__)
+    if existed:
+        migrate_database()
+        return False
     Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        _add_search_index(connection)
+        _add_catalog_version(connection)
+        applied = _applied_versions(connection)
+        for version, _, _ in MIGRATIONS:
+            if version not in applied:
+                connection.execute(SchemaVersion.__table__.insert(),
+                                   version=version)
+    return True
+
+
+def _applied_versions(connection):
+    '''Returns the set of migration versions applied to the database.'''
+    SchemaVersion.__table__.create(connection, checkfirst=True)
+    rows = connection.execute(sqla.select([SchemaVersion.version]))
+    return set(row.version for row in rows)
+
+
+def _add_lookup_indexes(connection):
+    '''Indexes the columns used to look up categories and sort items.'''
+    duplicated = connection.execute(
+        'SELECT name FROM categories GROUP BY name HAVING COUNT(*) > 1'
+    ).fetchall()
+    if duplicated:
+        raise ValueError('category names must be unique, rename: %s' %
+                         ', '.join(row.name for row in duplicated))
+    connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_categories_name '
+                       'ON categories (name)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_catalog_datetime '
+                       'ON catalog (datetime)')
+    connection.execute('CREATE INDEX IF NOT EXISTS '
+                       'ix_catalog_category_id_datetime '
+                       'ON catalog (category_id, datetime)')
+
+
+def _add_versions(connection):
+    '''Creates the table with the version counters used by the caches.'''
+    Version.__table__.create(connection, checkfirst=True)
+
+
+def _add_item_updated(connection):
+    '''Adds the date of the last change to the items.'''
+    connection.execute('ALTER TABLE catalog ADD COLUMN updated TIMESTAMP')
+    connection.execute('UPDATE catalog SET updated = datetime')
+
+
+def _add_uploads(connection):
+    '''Counts the items that use each uploaded file.'''
+    Upload.__table__.create(connection, checkfirst=True)
+    recount_uploads(connection)
+
+
+def recount_uploads(connection):
+    '''Counts again the items that use each uploaded file.
+
+    Args:
+        connection: Connection with an open transaction.
+    '''
+    connection.execute('DELETE FROM uploads')
+    connection.execute(
+        "INSERT INTO uploads (filename, refcount) "
+        "SELECT REPLACE(image, '/uploads/', ''), COUNT(*) FROM catalog "
+        "WHERE image IS NOT NULL AND image != '' "
+        "GROUP BY REPLACE(image, '/uploads/', '')"
+    )
+
+
+def _add_item_derivatives(connection):
+    '''Adds the resized versions of the item images.'''
+    connection.execute('ALTER TABLE catalog ADD COLUMN thumbnail VARCHAR(100)')
+    connection.execute('ALTER TABLE catalog '
+                       'ADD COLUMN detail_image VARCHAR(100)')
+
+
+def _add_search_index(connection):
+    '''Creates the full text index of the items.
+
+    The index is an sqlite FTS5 table that reads the text from the catalog
+    table, and triggers keep it updated. Other databases, or sqlite builds
+    without FTS5, are searched without index.
+    '''
+    if connection.dialect.name != 'sqlite':
+        return
+    try:
+        connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5("
+            "name, description, content='catalog', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 1')" % SEARCH_TABLE
+        )
+    except sqla.exc.OperationalError:
+        return
+    connection.execute(
+        "CREATE TRIGGER IF NOT EXISTS {0}_insert AFTER INSERT ON catalog "
+        "BEGIN INSERT INTO {0} (rowid, name, description) "
+        "VALUES (new.id, new.name, new.description); END".format(SEARCH_TABLE)
+    )
+    connection.execute(
+        "CREATE TRIGGER IF NOT EXISTS {0}_delete AFTER DELETE ON catalog "
+        "BEGIN INSERT INTO {0} ({0}, rowid, name, description) "
+        "VALUES ('delete', old.id, old.name, old.description); "
+        "END".format(SEARCH_TABLE)
+    )
+    connection.execute(
+        "CREATE TRIGGER IF NOT EXISTS {0}_update "
+        "AFTER UPDATE OF name, description ON catalog "
+        "BEGIN INSERT INTO {0} ({0}, rowid, name, description) "
+        "VALUES ('delete', old.id, old.name, old.description); "
+        "INSERT INTO {0} (rowid, name, description) "
+        "VALUES (new.id, new.name, new.description); END".format(SEARCH_TABLE)
+    )
+    connection.execute("INSERT INTO {0} ({0}) VALUES ('rebuild')"
+                       .format(SEARCH_TABLE))
+
+
+def _add_catalog_version(connection):
+    '''Records the date of the last change to the catalog.
+
+    The counter starts at 0 with the date of the most recent item, so the
+    catalog has a Last-Modified date before its first change.
+    '''
+    existing = connection.execute(sqla.select([Version.name]).where(
+        Version.name == CATALOG_VERSION
+    )).first()
+    if existing is not None:
+        return
+    # The type is lost by the aggregate, and sqlite would return a string.
+    last_change = connection.execute(sqla.select([sqla.type_coerce(
+        sqla.func.max(sqla.func.coalesce(Item.updated, Item.datetime)),
+        sqla.DateTime
+    )])).scalar()
+    connection.execute(Version.__table__.insert(), name=CATALOG_VERSION,
+                       value=0, updated=last_change or _now())
+
+
+def has_search_index(connection):
+    '''Returns true if the database has the full text index of the items.'''
+    if connection.dialect.name != 'sqlite':
+        return False
+    return connection.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE name = ?", SEARCH_TABLE
+    ).scalar() > 0
+
+
+def rebuild_search_index():
+    '''Builds again the full text index from the items.
+
+    Returns:
+        False if the database has no full text index.
+    '''
+    with get_engine().begin() as connection:
+        if not has_search_index(connection):
+            return False
+        connection.execute("INSERT INTO {0} ({0}) VALUES ('rebuild')"
+                           .format(SEARCH_TABLE))
+        connection.execute("INSERT INTO {0} ({0}) VALUES ('optimize')"
+                           .format(SEARCH_TABLE))
+    return True
+
+
+# Ordered list of (version, description, function) applied by
+# migrate_database(). New migrations must be appended with a higher version.
+MIGRATIONS = [
+    (1, 'Index the hot lookup columns', _add_lookup_indexes),
+    (2, 'Add the cache version counters', _add_versions),
+    (3, 'Add the last change date of the items', _add_item_updated),
+    (4, 'Add the reference count of the uploads', _add_uploads),
+    (5, 'Add the resized images of the items', _add_item_derivatives),
+    (6, 'Add the full text index of the items', _add_search_index),
+    (7, 'Add the last change date of the catalog', _add_catalog_version),
+]
+
+
+def migrate_database():
+    '''Applies the pending migrations to an existing database.
+
+    Each migration runs in its own transaction and is recorded in the
+    schema_version table, so running the command again is harmless.
+
+    Returns:
+        List with the versions that were applied.
+    '''
+    engine = get_engine()
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        with engine.begin() as connection:
+            if version in _applied_versions(connection):
+                continue
+            migration(connection)
+            connection.execute(SchemaVersion.__table__.insert(),
+                               version=version)
+        applied.append((version, description))
+    return applied
+
+
+def explain_queries():
+    '''Shows the plan that the database uses for the hot catalog queries.
+
+    Only works with sqlite, because it relies on EXPLAIN QUERY PLAN.
+
+    Returns:
+        A list of (description, plan, uses_index) tuples.
+    '''
+    engine = get_engine()
+    db_session = get_session()
+    queries = [
+        ('category by name', db_session.query(Category).filter(
+            Category.name == 'Colors'
+        )),
+        ('recent items', db_session.query(Item).order_by(
+            Item.datetime.desc()
+        ).limit(8)),
+        ('category items', db_session.query(Item).filter(
+            Item.category_id == 1
+        ).order_by(Item.datetime.desc())),
+    ]
+    plans = []
+    for description, query in queries:
+        compiled = query.statement.compile(dialect=engine.dialect)
+        params = [compiled.params[key] for key in compiled.positiontup]
+        rows = engine.execute('EXPLAIN QUERY PLAN %s' % compiled, params)
+        plan = ' / '.join(list(row)[-1] for row in rows)
+        plans.append((description, plan, 'USING' in plan and 'INDEX' in plan))
+    remove_session()
+    return plans
 
 
 def fill_default_data():
@@ -124,13 +702,41 @@ def fill_default_data():
                         category=new_category)
         db_session.add(new_item)
 
+    bump_version(db_session, CATALOG_VERSION)
     db_session.commit()
+    remove_session()
 
 
 if __name__ == '__main__':
-    print 'Creating database...'
-    create_database()
-    print 'Database created.'
-    print 'Filling database with default data...'
-    fill_default_data()
-    print 'Default data added.'
+    command = sys.argv[1] if len(sys.argv) > 1 else 'init'
+    if command == 'init':
+        print 'Creating database...'
+        if create_database():
+            print 'Database created.'
+            print 'Filling database with default data...'
+            fill_default_data()
+            print 'Default data added.'
+        else:
+            print 'The database already existed, it was migrated.'
+    elif command == 'migrate':
+        print 'Migrating database...'
+        for version, description in migrate_database():
+            print 'Applied migration %d: %s' % (version, description)
+        print 'Database is up to date.'
+    elif command == 'explain':
+        indexed = True
+        for description, plan, uses_index in explain_queries():
+            print '%s: %s' % (description, plan)
+            indexed = indexed and uses_index
+        if not indexed:
+            print 'Some queries are not using an index.'
+            sys.exit(1)
+    elif command == 'reindex':
+        if rebuild_search_index():
+            print 'Search index rebuilt.'
+        else:
+            print 'The database has no search index, run migrate first.'
+            sys.exit(1)
+    else:
+        print 'Usage: python database.py [init|migrate|explain|reindex]'
+        sys.exit(2)
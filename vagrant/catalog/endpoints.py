@@ -4,19 +4,293 @@
 import json
 
 import flask
+import sqlalchemy as sqla
 from werkzeug.contrib import atom
 
+import conditional
 import database
+import recent_items
+import serializers
+
+# Number of items serialized before sending a chunk of the JSON catalog.
+JSON_CHUNK_SIZE = 100
+
+
+def _int_arg(name):
+    """Reads an optional integer argument from the query string.
+
+    Args:
+        name: Name of the argument.
+
+    Returns:
+        The integer value, or None if the argument is not present.
+    """
+    value = flask.request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        flask.abort(400)
+    if value < 0:
+        flask.abort(400)
+    return value
+
+
+def _follows_item(after):
+    """Returns the condition of the items that are older than an item.
+
+    The values of the item are compared inside the database, so the dates
+    are not converted from and to python.
+
+    Args:
+        after: Id of the item.
+    """
+    items = database.Item.__table__
+    last = items.alias('last')
+    last_datetime = sqla.select([last.c.datetime]).where(
+        last.c.id == after
+    ).as_scalar()
+    return sqla.or_(
+        items.c.datetime < last_datetime,
+        sqla.and_(items.c.datetime == last_datetime, items.c.id < after)
+    )
+
+
+def _catalog_rows(db_session, category_name=None, after=None,
+                  after_category=None, limit=None):
+    """Reads the catalog rows without building the ORM objects.
+
+    Rows are sorted by category, and then by the most recent item. Empty
+    categories are included as a single row without item.
+
+    Args:
+        db_session: The database session.
+        category_name: Only read the items of this category.
+        after: Id of an item, only the items that follow it are read.
+        after_category: Id of a category, only the categories that follow it
+            are read. Used after an empty category, that has no item.
+        limit: Maximum number of rows.
+
+    Returns:
+        A result proxy that fetches the rows from a server side cursor.
+    """
+    categories = database.Category.__table__
+    items = database.Item.__table__
+    query = sqla.select([
+        categories.c.id.label('category_id'),
+        categories.c.name.label('category_name'),
+        items.c.id.label('item_id'),
+        items.c.name.label('item_name'),
+        items.c.description,
+        items.c.image,
+    ]).select_from(
+        categories.outerjoin(items)
+    ).order_by(
+        categories.c.id, items.c.datetime.desc(), items.c.id.desc()
+    )
+
+    if category_name is not None:
+        category_id = db_session.query(database.Category.id).filter(
+            database.Category.name == category_name
+        ).scalar()
+        if category_id is None:
+            flask.abort(404)
+        query = query.where(categories.c.id == category_id)
+    if after is not None:
+        if db_session.query(database.Item.id).filter(
+            database.Item.id == after
+        ).scalar() is None:
+            flask.abort(400)
+        last = items.alias('last')
+        last_category_id = sqla.select([last.c.category_id]).where(
+            last.c.id == after
+        ).as_scalar()
+        query = query.where(sqla.or_(
+            categories.c.id > last_category_id,
+            sqla.and_(categories.c.id == last_category_id,
+                      _follows_item(after))
+        ))
+    if after_category is not None:
+        query = query.where(categories.c.id > after_category)
+    if limit is not None:
+        query = query.limit(limit)
+
+    return db_session.execute(query.execution_options(stream_results=True))
+
+
+def _stream_catalog(rows):
+    """Serializes the catalog rows as a JSON list of categories.
+
+    Args:
+        rows: Catalog rows sorted by category.
+
+    Yields:
+        Chunks of the JSON document.
+    """
+    chunk = ['[']
+    category_id = None
+    first_item = True
+    for row in rows:
+        if row.category_id != category_id:
+            if category_id is not None:
+                chunk.append(']}, ')
+            category_id = row.category_id
+            chunk.append('{"id": %d, "name": %s, "items": [' %
+                         (row.category_id, json.dumps(row.category_name)))
+            first_item = True
+        if row.item_id is not None:
+            if not first_item:
+                chunk.append(', ')
+            chunk.append(json.dumps({
+                'id': row.item_id,
+                'name': row.item_name,
+                'description': row.description,
+                'image': row.image
+            }))
+            first_item = False
+        if len(chunk) >= JSON_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    rows.close()
+    if category_id is not None:
+        chunk.append(']}')
+    chunk.append(']')
+    yield ''.join(chunk)
+
 
 def load_controllers(app):
     """Defines the controlleres on the Flask app."""
 
     @app.route('/catalog.json')
     def json_api():
-        """Shows the entire catalog as a JSON file."""
-        db_session = database.get_session()
-        catalog = db_session.query(database.Category).all()
-        return json.dumps(catalog, default=database.parseJSON)
+        """Shows the catalog as a JSON file.
+
+        The file is streamed while it is read from the database. Large catalogs
+        can be read in pages with the optional query string arguments:
+
+            category: Only show the category with this name.
+            limit: Maximum number of items in the page.
+            after: Id of the last item of the previous page.
+            after_category: Id of the last category of the previous page,
+                instead of after when that category is empty.
+
+        A page with less items than the limit is the last one. Empty
+        categories count as one item.
+        """
+        db_session = database.get_read_session()
+        version, last_modified = conditional.catalog_stamp(db_session)
+        etag = conditional.make_etag(flask.request.full_path, version)
+        response = conditional.not_modified(etag, last_modified)
+        if response is not None:
+            return response
+
+        after = _int_arg('after')
+        after_category = _int_arg('after_category')
+        if after is not None and after_category is not None:
+            flask.abort(400)
+        rows = _catalog_rows(db_session,
+                             category_name=flask.request.args.get('category'),
+                             after=after, after_category=after_category,
+                             limit=_int_arg('limit'))
+        return conditional.add_validators(
+            flask.Response(flask.stream_with_context(_stream_catalog(rows)),
+                           mimetype='application/json'),
+            etag, last_modified
+        )
+
+    @app.route('/catalog/<string:category_name>.json')
+    def category_json(category_name):
+        """Shows the items of a category as JSON or MessagePack.
+
+        The query string arguments are optional:
+
+            fields: Comma separated fields of the items, only those columns
+                are read from the database.
+            limit: Maximum number of items.
+            after: Id of the last item of the previous page.
+
+        Args:
+            category_name: Name of the category.
+        """
+        db_session = database.get_read_session()
+        fields = serializers.requested_fields()
+        mimetype = serializers.response_mimetype()
+        version, last_modified = conditional.catalog_stamp(db_session)
+        etag = conditional.make_etag(flask.request.full_path, mimetype,
+                                     version)
+        response = conditional.not_modified(etag, last_modified)
+        if response is not None:
+            return response
+
+        category = db_session.query(
+            database.Category.id, database.Category.name
+        ).filter(database.Category.name == category_name).first()
+        if category is None:
+            flask.abort(404)
+        query = sqla.select(serializers.select_columns(fields)).where(
+            database.Item.category_id == category.id
+        ).order_by(database.Item.datetime.desc(), database.Item.id.desc())
+        if 'category' in fields:
+            query = query.select_from(database.Item.__table__.join(
+                database.Category.__table__
+            ))
+        after = _int_arg('after')
+        if after is not None:
+            if db_session.query(database.Item.id).filter(
+                database.Item.id == after,
+                database.Item.category_id == category.id
+            ).scalar() is None:
+                flask.abort(400)
+            query = query.where(_follows_item(after))
+        limit = _int_arg('limit')
+        if limit is not None:
+            query = query.limit(limit)
+
+        items = [serializers.to_record(row, fields)
+                 for row in db_session.execute(query)]
+        return conditional.add_validators(
+            serializers.make_response(
+                {'id': category.id, 'name': category.name, 'items': items},
+                mimetype
+            ),
+            etag, last_modified
+        )
+
+    @app.route('/catalog/<string:category_name>/<int:item_id>.json')
+    def item_json(category_name, item_id):
+        """Shows an item as JSON or MessagePack.
+
+        The fields argument of the query string chooses the fields, like in
+        category_json.
+
+        Args:
+            category_name: Name of the category of the item.
+            item_id: Id of the item.
+        """
+        db_session = database.get_read_session()
+        fields = serializers.requested_fields()
+        mimetype = serializers.response_mimetype()
+        version, last_modified = conditional.catalog_stamp(db_session)
+        etag = conditional.make_etag(flask.request.full_path, mimetype,
+                                     version)
+        response = conditional.not_modified(etag, last_modified)
+        if response is not None:
+            return response
+
+        row = db_session.execute(
+            sqla.select(serializers.select_columns(fields)).select_from(
+                database.Item.__table__.join(database.Category.__table__)
+            ).where(sqla.and_(database.Item.id == item_id,
+                              database.Category.name == category_name))
+        ).first()
+        if row is None:
+            flask.abort(404)
+        return conditional.add_validators(
+            serializers.make_response(serializers.to_record(row, fields),
+                                      mimetype),
+            etag, last_modified
+        )
 
     @app.route('/feed.atom')
     def atom_feed():
@@ -24,21 +298,33 @@ def load_controllers(app):
 
         Based on http://flask.pocoo.org/snippets/10/
         """
-        db_session = database.get_session()
-        feed = atom.AtomFeed('Recently added items',
-                             feed_url=flask.request.url,
-                             url=flask.request.url_root)
-        items = db_session.query(database.Item).order_by(
-            database.Item.datetime.desc()
-        ).limit(20).all()
-
-        for item in items:
-            feed.add(item.name, unicode(item.description),
-                     content_type='html',
-                     url='%scatalog/%s/%d' % (flask.request.url_root,
-                                              item.category.name,
-                                              item.id),
-                     updated=item.datetime,
-                     published=item.datetime)
-        return feed.get_response()
+        db_session = database.get_read_session()
+        version, last_modified = conditional.catalog_stamp(db_session)
+        etag = conditional.make_etag(flask.request.url, version)
+        response = conditional.not_modified(etag, last_modified)
+        if response is not None:
+            return response
+
+        def render(items):
+            """Renders the feed with the recent items."""
+            feed = atom.AtomFeed('Recently added items',
+                                 feed_url=flask.request.url,
+                                 url=flask.request.url_root)
+            for item in items[:20]:
+                feed.add(item.name, unicode(item.description),
+                         content_type='html',
+                         url='%scatalog/%s/%d' % (flask.request.url_root,
+                                                  item.category_name,
+                                                  item.id),
+                         updated=item.datetime,
+                         published=item.datetime)
+            return feed.to_string()
+
+        return conditional.add_validators(
+            flask.Response(
+                recent_items.get_feed(db_session, flask.request.url, render),
+                mimetype='application/atom+xml'
+            ),
+            etag, last_modified
+        )
 
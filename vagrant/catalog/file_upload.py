@@ -1,12 +1,44 @@
 # coding: utf-8
-"""Functions that help with the file upload process."""
+"""Functions that help with the file upload process.
 
+Run `python file_upload.py gc` to delete the files in the uploads folder that
+no item uses, left by an interrupted request.
+"""
+
+import hashlib
+import logging
 import os
+import re
+import sys
+import tempfile
+import time
+import weakref
+from multiprocessing import pool
 
 import flask
-import werkzeug as wkz
+import sqlalchemy as sqla
+from sqlalchemy import orm
 
 import config
+import database
+import static_files
+
+# Bytes read at a time while an upload is hashed.
+CHUNK_SIZE = 64 * 1024
+
+# Kinds of resized versions generated for the uploaded images.
+DERIVATIVES = ['thumbnail', 'detail']
+
+# Names of the stored files, that are the hash of their contents.
+HASHED_NAME = re.compile(r'^[0-9a-f]{64}(_[a-z]+)?\.\w+$')
+
+# Prefix of the temporary files written while an upload is hashed.
+TEMP_PREFIX = '.upload-'
+
+# Files removed by each session once it is commited, with the time they were
+# released.
+_pending = weakref.WeakKeyDictionary()
+_pool = None
 
 
 def is_allowed(filename):
@@ -22,30 +54,261 @@ def is_allowed(filename):
             filename.rsplit('.', 1)[1] in config.ALLOWED_EXTENSIONS)
 
 
-def save_upload():
+def upload_folder():
+    """Returns the absolute path of the uploads folder."""
+    here = os.path.dirname(__file__)
+    return os.path.join(here, config.UPLOAD_FOLDER)
+
+
+def derivative_name(filename, kind):
+    """Returns the name of a resized version of an uploaded file.
+
+    Args:
+        filename: Name of the original file.
+        kind: Kind of resized version, one of DERIVATIVES.
+    """
+    name, extension = filename.rsplit('.', 1)
+    return '%s_%s.%s' % (name, kind, extension)
+
+
+def derivative_names(filename):
+    """Returns the names of all the resized versions of a file."""
+    return [derivative_name(filename, kind) for kind in DERIVATIVES]
+
+
+def _add_reference(db_session, filename):
+    """Counts a new item that uses the file.
+
+    Args:
+        db_session: The database session.
+        filename: Name of the file in the uploads folder.
+    """
+    updated = db_session.query(database.Upload).filter(
+        database.Upload.filename == filename
+    ).update({database.Upload.refcount: database.Upload.refcount + 1},
+             synchronize_session=False)
+    if not updated:
+        db_session.add(database.Upload(filename=filename, refcount=1))
+
+
+def _remove_reference(db_session, filename):
+    """Discounts an item that no longer uses the file.
+
+    Args:
+        db_session: The database session.
+        filename: Name of the file in the uploads folder.
+
+    Returns:
+        The number of items that still use the file, or None if the file is
+        not counted.
+    """
+    db_session.query(database.Upload).filter(
+        database.Upload.filename == filename
+    ).update({database.Upload.refcount: database.Upload.refcount - 1},
+             synchronize_session=False)
+    return db_session.query(database.Upload.refcount).filter(
+        database.Upload.filename == filename
+    ).scalar()
+
+
+def save_upload(db_session):
     """Save the uploaded file in the uploads directory.
 
+    The file is copied to a temporary file in chunks while it is hashed, and
+    then stored with the hash as its name. Identical files are stored only
+    once, and the number of items that use them is counted in the session.
+
+    Args:
+        db_session: The database session.
+
     Returns:
         The route of the uploaded file
     """
     file_ = flask.request.files['file']
     if file_ and is_allowed(file_.filename):
-        filename = wkz.secure_filename(file_.filename)
-        here = os.path.dirname(__file__)
-        file_.save(os.path.join(here, config.UPLOAD_FOLDER, filename))
+        folder = upload_folder()
+        digest = hashlib.sha256()
+        handle, temp_path = tempfile.mkstemp(dir=folder, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                chunk = file_.stream.read(CHUNK_SIZE)
+                while chunk:
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+                    chunk = file_.stream.read(CHUNK_SIZE)
+            filename = '%s.%s' % (digest.hexdigest(),
+                                  file_.filename.rsplit('.', 1)[1])
+            path = os.path.join(folder, filename)
+            if os.path.exists(path):
+                os.remove(temp_path)
+                # A removal scheduled before now must keep the file.
+                os.utime(path, None)
+            else:
+                os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        _add_reference(db_session, filename)
         return flask.url_for('get_uploaded_file', filename=filename)
     else:
         return ''
 
 
-def delete_upload(filename):
+def delete_upload(db_session, route):
     """Deletes a file in the upload folder.
 
+    The file is only removed when no other item uses it. It is removed in the
+    background after the session is commited, and kept if it is rolled back.
+
     Args:
-        filename: name of the file to be delete.
+        db_session: The database session.
+        route: route of the file to be deleted.
     """
-    here = os.path.dirname(__file__)
-    os.remove(os.path.join(here, filename.strip('/')))
+    filename = os.path.basename(route)
+    if _remove_reference(db_session, filename) == 0:
+        db_session.query(database.Upload).filter(
+            database.Upload.filename == filename
+        ).delete(synchronize_session=False)
+        _pending.setdefault(db_session, {})[filename] = time.time()
+
+
+def _get_pool():
+    """Returns the thread that removes the files, created on first use."""
+    global _pool
+    if _pool is None:
+        _pool = pool.ThreadPool(1)
+    return _pool
+
+
+def reset_after_fork():
+    """Forgets the thread that removes the files after a fork.
+
+    The thread only runs in the parent process, so the child starts its own
+    one when a file is released.
+    """
+    global _pool
+    _pool = None
+
+
+@sqla.event.listens_for(orm.Session, 'after_commit')
+def _after_commit(db_session):
+    """Removes the files released by a session that was commited."""
+    released = _pending.pop(db_session, None)
+    if released:
+        _get_pool().apply_async(_remove_files, (released,))
+
+
+@sqla.event.listens_for(orm.Session, 'after_rollback')
+def _after_rollback(db_session):
+    """Keeps the files released by a session that was rolled back."""
+    _pending.pop(db_session, None)
+
+
+def _remove_files(released):
+    """Removes the released files and their resized versions.
+
+    A file is kept if it was counted again, or uploaded again since it was
+    released.
+
+    Args:
+        released: Dictionary with the time each file was released.
+    """
+    db_session = database.get_session()
+    try:
+        used = set(name for name, in db_session.query(
+            database.Upload.filename
+        ).filter(database.Upload.filename.in_(list(released))))
+        for filename, released_at in released.items():
+            path = os.path.join(upload_folder(), filename)
+            if (filename in used or not os.path.exists(path) or
+                    os.path.getmtime(path) > released_at):
+                continue
+            for name in [filename] + derivative_names(filename):
+                try:
+                    os.remove(os.path.join(upload_folder(), name))
+                except OSError:
+                    pass
+    except Exception:
+        logging.exception('Could not remove %s', ', '.join(released))
+    finally:
+        database.remove_session()
+
+
+def _original_name(name):
+    """Returns the name of the original of a resized file."""
+    for kind in DERIVATIVES:
+        suffix = '_%s.' % kind
+        if suffix in name:
+            return name.replace(suffix, '.')
+    return name
+
+
+def _used_files(db_session, names):
+    """Returns the original files, from a list, that are still in use.
+
+    A file is in use when it is counted in the uploads table, or when an item
+    has its route.
+    """
+    used = set(name for name, in db_session.query(
+        database.Upload.filename
+    ).filter(database.Upload.filename.in_(names)))
+    routes = dict(('/%s/%s' % (config.UPLOAD_FOLDER, name), name)
+                  for name in names)
+    for column in (database.Item.image, database.Item.thumbnail,
+                   database.Item.detail_image):
+        rows = db_session.query(column).filter(column.in_(list(routes)))
+        used.update(routes[route] for route, in rows)
+    return used
+
+
+def collect_garbage(dry_run=False, batch_size=500, grace=3600):
+    """Deletes the files of the uploads folder that no item uses.
+
+    The folder is checked against the database in batches. Files modified in
+    the last seconds are kept, since their items may not be commited yet.
+
+    Args:
+        dry_run: If true, the orphan files are reported but not deleted.
+        batch_size: Number of files checked with each query.
+        grace: Seconds during which a new file is kept.
+
+    Returns:
+        A dictionary with the number of scanned and orphan files, the bytes
+        reclaimed, and the elapsed seconds.
+    """
+    start = time.time()
+    folder = upload_folder()
+    stats = dict(scanned=0, orphans=0, bytes=0)
+    names = [name for name in os.listdir(folder)
+             if HASHED_NAME.match(name) or name.startswith(TEMP_PREFIX)]
+    db_session = database.get_session()
+    try:
+        for first in xrange(0, len(names), batch_size):
+            batch = names[first:first + batch_size]
+            used = _used_files(db_session, list(set(
+                _original_name(name) for name in batch
+                if not name.startswith(TEMP_PREFIX)
+            )))
+            for name in batch:
+                stats['scanned'] += 1
+                path = os.path.join(folder, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                if (_original_name(name) in used or
+                        status.st_mtime > start - grace):
+                    continue
+                stats['orphans'] += 1
+                stats['bytes'] += status.st_size
+                print '%s %s' % ('Orphan' if dry_run else 'Deleted', name)
+                if not dry_run:
+                    os.remove(path)
+    finally:
+        database.remove_session()
+    stats['seconds'] = time.time() - start
+    return stats
 
 
 def load_controllers(app):
@@ -59,10 +322,34 @@ def load_controllers(app):
     def get_uploaded_file(filename):
         """Gets a file that is stored on the uploads folder.
 
+        Files named with the hash of their contents never change, so they are
+        sent with a long expiration.
+
         Args:
             filename: The name of the file.
 
         Returns:
             The contents of the file.
         """
-        return flask.send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+        return static_files.send_file(
+            app.config['UPLOAD_FOLDER'], filename,
+            immutable=HASHED_NAME.match(filename) is not None
+        )
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    if not arguments or arguments[0] != 'gc':
+        print 'Usage: python file_upload.py gc [--dry-run] [--batch-size N]'
+        sys.exit(2)
+    options = dict(dry_run='--dry-run' in arguments)
+    if '--batch-size' in arguments:
+        options['batch_size'] = int(
+            arguments[arguments.index('--batch-size') + 1]
+        )
+    result = collect_garbage(**options)
+    print ('Scanned %d files in %.2f seconds (%.0f files/s), %s %d orphans '
+           '(%d bytes).' % (result['scanned'], result['seconds'],
+                            result['scanned'] / max(result['seconds'], 1e-6),
+                            'found' if options['dry_run'] else 'deleted',
+                            result['orphans'], result['bytes']))
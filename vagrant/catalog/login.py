@@ -1,20 +1,127 @@
 # coding: utf-8
-"""Defines the controllers for user login."""
+"""Defines the controllers for user login.
+
+The calls to Google share a pool of keep-alive connections, and the token
+information and the user profile are requested at the same time. The answers
+are cached for a short time by access token, so repeated logins with the same
+token don't call Google again. The urls are in config, so the flow can be
+tried against a local server that imitates Google.
+"""
 import os
-import httplib2
 import json
 import random
 import string
+from multiprocessing import pool
 
 import flask
 from flask import session as login_session
+import httplib2
 from oauth2client import client
 import requests
+from requests import adapters
+
+import config
+import lru
 
 here = os.path.dirname(__file__)
 
-CLIENT_ID = json.loads(
-    open(os.path.join(here, 'client_secrets.json'), 'r').read())['web']['client_id']
+with open(os.path.join(here, 'client_secrets.json'), 'r') as secrets_file:
+    CLIENT_SECRETS = json.load(secrets_file)['web']
+CLIENT_ID = CLIENT_SECRETS['client_id']
+
+# Keep-alive connections shared by all the calls to Google.
+_http = requests.Session()
+_http.mount('https://', adapters.HTTPAdapter(
+    pool_connections=4, pool_maxsize=config.GOOGLE_HTTP_POOL_SIZE
+))
+_http.mount('http://', adapters.HTTPAdapter(
+    pool_connections=4, pool_maxsize=config.GOOGLE_HTTP_POOL_SIZE
+))
+_pool = None
+# Token information and user profile of the recent access tokens.
+_tokens = lru.LRUCache(config.GOOGLE_TOKEN_CACHE_SIZE,
+                       config.GOOGLE_TOKEN_CACHE_TTL)
+
+
+class SharedHttp(object):
+    """Makes the requests of oauth2client with the shared connections.
+
+    oauth2client expects an httplib2.Http object, so the answers are
+    converted to httplib2 responses.
+    """
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        answer = _http.request(method, uri, data=body, headers=headers,
+                               timeout=config.GOOGLE_HTTP_TIMEOUT)
+        info = dict(answer.headers)
+        info['status'] = str(answer.status_code)
+        return httplib2.Response(info), answer.content
+
+
+def _get_pool():
+    """Returns the threads that call Google, created on first use."""
+    global _pool
+    if _pool is None:
+        _pool = pool.ThreadPool(config.GOOGLE_HTTP_POOL_SIZE)
+    return _pool
+
+
+def reset_after_fork():
+    """Forgets the threads that call Google after a fork.
+
+    They only run in the parent process; the child creates new ones on its
+    first login.
+    """
+    global _pool
+    _pool = None
+
+
+def _get_json(url, params):
+    """Requests a Google url and reads the JSON answer."""
+    return _http.get(url, params=params,
+                     timeout=config.GOOGLE_HTTP_TIMEOUT).json()
+
+
+def exchange_code(code):
+    """Upgrades an authorization code into a credentials object.
+
+    Raises:
+        client.FlowExchangeError: The code was not accepted.
+    """
+    oauth_flow = client.OAuth2WebServerFlow(
+        CLIENT_ID, CLIENT_SECRETS['client_secret'], scope='',
+        redirect_uri='postmessage',
+        token_uri=config.GOOGLE_TOKEN_URL or CLIENT_SECRETS['token_uri']
+    )
+    return oauth_flow.step2_exchange(code, http=SharedHttp())
+
+
+def token_details(access_token):
+    """Returns the token information and the user profile of a token.
+
+    Both are requested at the same time, and cached for a short time.
+
+    Args:
+        access_token: The access token of the user.
+
+    Returns:
+        A tuple with the token information and the user profile.
+    """
+    details = _tokens.get(access_token)
+    if details is None:
+        tokeninfo = _get_pool().apply_async(_get_json, (
+            config.GOOGLE_TOKENINFO_URL, {'access_token': access_token}
+        ))
+        userinfo = _get_pool().apply_async(_get_json, (
+            config.GOOGLE_USERINFO_URL,
+            {'access_token': access_token, 'alt': 'json'}
+        ))
+        details = (tokeninfo.get(config.GOOGLE_HTTP_TIMEOUT),
+                   userinfo.get(config.GOOGLE_HTTP_TIMEOUT))
+        if details[0].get('error') is None:
+            _tokens.set(access_token, details)
+    return details
+
 
 def load_controllers(app, csrf):
     """Defines the module controllers."""
@@ -44,10 +151,7 @@ def load_controllers(app, csrf):
 
         try:
             # Upgrade the authorization code into a credentials object
-            oauth_flow = client.flow_from_clientsecrets('client_secrets.json',
-                                                        scope='')
-            oauth_flow.redirect_uri = 'postmessage'
-            credentials = oauth_flow.step2_exchange(code)
+            credentials = exchange_code(code)
         except client.FlowExchangeError:
             response = flask.make_response(
                 json.dumps('Failed to upgrade the authorization code.'), 401
@@ -55,17 +159,14 @@ def load_controllers(app, csrf):
             response.headers['Content-Type'] = 'application/json'
             return response
 
-        # Check that the access token is valid.
-        access_token = credentials.access_token
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-               % access_token)
-        h = httplib2.Http()
-        result = json.loads(h.request(url, 'GET')[1])
+        # Check that the access token is valid, and get the user info.
+        result, data = token_details(credentials.access_token)
         # If there was an error in the access token info, abort.
         if result.get('error') is not None:
             response = flask.make_response(json.dumps(result.get('error')),
                                            500)
             response.headers['Content-Type'] = 'application/json'
+            return response
 
         # Verify that the access token is used for the intended user.
         gplus_id = credentials.id_token['sub']
@@ -98,16 +199,11 @@ def load_controllers(app, csrf):
         login_session['credentials'] = credentials.access_token
         login_session['gplus_id'] = gplus_id
 
-        # Get user info
-        userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-        params = {'access_token': credentials.access_token, 'alt': 'json'}
-        answer = requests.get(userinfo_url, params=params)
-
-        data = answer.json()
-
         login_session['username'] = data['name']
         login_session['picture'] = data['picture']
         login_session['email'] = data['email']
+        # A session id known before the login can't be used after it.
+        login_session.regenerate()
 
         print "done!"
         return 'ok'
@@ -124,18 +220,19 @@ def load_controllers(app, csrf):
             response.headers['Content-Type'] = 'application/json'
             return response
 
-        url = ('https://accounts.google.com/o/oauth2/revoke?token=%s'
-               % access_token)
-        h = httplib2.Http()
-        result = h.request(url, 'GET')[0]
+        answer = _http.get(config.GOOGLE_REVOKE_URL,
+                           params={'token': access_token},
+                           timeout=config.GOOGLE_HTTP_TIMEOUT)
+        _tokens.delete(access_token)
 
-        if result['status'] == '200':
+        if answer.status_code == 200:
             # Reset the user's sesson.
             del login_session['credentials']
             del login_session['gplus_id']
             del login_session['username']
             del login_session['email']
             del login_session['picture']
+            login_session.regenerate()
 
             return flask.redirect(flask.url_for('show_catalog'))
         else:
@@ -145,6 +242,7 @@ def load_controllers(app, csrf):
             del login_session['username']
             del login_session['email']
             del login_session['picture']
+            login_session.regenerate()
 
             response = flask.make_response(
                 json.dumps('Failed to revoke token for given user.'), 400
@@ -0,0 +1,59 @@
+# coding: utf-8
+"""Bounded in-memory cache shared by the caches of each process."""
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """Bounded in-memory cache where the entries expire.
+
+    When the cache is full, the least recently used entry is discarded.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the value of the key, or None if it is not cached."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        """Adds a value, discarding the oldest entries if the cache is full."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Deletes the value of the key, if it is cached."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_if(self, condition):
+        """Deletes all the values that meet the condition."""
+        with self._lock:
+            for key, (value, _) in self._entries.items():
+                if condition(value):
+                    del self._entries[key]
+
+    def clear(self):
+        """Deletes all the values."""
+        with self._lock:
+            self._entries.clear()
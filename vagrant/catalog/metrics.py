@@ -0,0 +1,252 @@
+# coding: utf-8
+"""Metrics of the requests, exposed in the Prometheus text format.
+
+For each endpoint the latency, the size of the responses and the SQL
+statements are recorded, and for each template the render time. The values
+are aggregated in memory when they are observed, in fixed histogram buckets,
+so recording them costs a few dictionary updates and they can be always on.
+Every process keeps its own metrics, so /metrics must be scraped from each
+process.
+"""
+
+import bisect
+import collections
+import threading
+import timeit
+
+import flask
+import jinja2
+import sqlalchemy as sqla
+
+import page_cache
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0]
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+STATEMENT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter(object):
+    """Values that only grow, by label."""
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        """Increments the value of the labels."""
+        with self._lock:
+            self._values[label_values] += amount
+
+    def samples(self):
+        """Returns the (suffix, labels, value) of each sample."""
+        with self._lock:
+            values = self._values.items()
+        return [('', zip(self.labels, label_values), value)
+                for label_values, value in sorted(values)]
+
+
+class Histogram(object):
+    """Distribution of the observed values in buckets, by label."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        """Adds a value to the histogram of the labels."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0.0
+                ]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        """Returns the (suffix, labels, value) of each sample.
+
+        The buckets are cumulative, like Prometheus expects.
+        """
+        with self._lock:
+            values = [(key, list(counts), total)
+                      for key, (counts, total) in self._values.items()]
+        samples = []
+        for label_values, counts, total in sorted(values):
+            labels = zip(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += count
+                samples.append(('_bucket', labels + [('le', str(bound))],
+                                cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+REQUEST_LATENCY = Histogram(
+    'catalog_request_duration_seconds', 'Time to build the responses.',
+    ['endpoint', 'method'], LATENCY_BUCKETS
+)
+REQUESTS = Counter('catalog_requests_total', 'Responses by status.',
+                   ['endpoint', 'method', 'status'])
+RESPONSE_SIZE = Histogram(
+    'catalog_response_size_bytes',
+    'Size of the responses that are not streamed.',
+    ['endpoint'], SIZE_BUCKETS
+)
+REQUEST_STATEMENTS = Histogram(
+    'catalog_request_sql_statements', 'SQL statements run by each request.',
+    ['endpoint'], STATEMENT_BUCKETS
+)
+SQL_STATEMENTS = Counter('catalog_sql_statements_total',
+                         'SQL statements run by the endpoints.', ['endpoint'])
+SQL_TIME = Counter('catalog_sql_seconds_total',
+                   'Time spent running SQL statements.', ['endpoint'])
+TEMPLATE_RENDER = Histogram(
+    'catalog_template_render_seconds', 'Time to render the templates.',
+    ['template'], LATENCY_BUCKETS
+)
+
+METRICS = [REQUEST_LATENCY, REQUESTS, RESPONSE_SIZE, REQUEST_STATEMENTS,
+           SQL_STATEMENTS, SQL_TIME, TEMPLATE_RENDER]
+
+
+class TimedTemplate(jinja2.Template):
+    """Template that records the time it takes to render."""
+
+    def render(self, *args, **kwargs):
+        start = timeit.default_timer()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            TEMPLATE_RENDER.observe((self.name or '<string>',),
+                                    timeit.default_timer() - start)
+
+
+def _endpoint():
+    """Returns the endpoint of the current request, or None outside one."""
+    if not flask.has_request_context():
+        return None
+    return flask.request.endpoint or 'none'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    """Remembers when a statement started.
+
+    The time is kept in the context of the statement, that is discarded with
+    it when the statement fails and the after event never comes.
+    """
+    if context is not None:
+        context.metrics_start = timeit.default_timer()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    """Counts a statement and its time for the current endpoint."""
+    endpoint = _endpoint()
+    if endpoint is None:
+        return
+    SQL_STATEMENTS.inc((endpoint,))
+    start = getattr(context, 'metrics_start', None)
+    if start is not None:
+        SQL_TIME.inc((endpoint,), timeit.default_timer() - start)
+    if hasattr(flask.g, 'metrics_statements'):
+        flask.g.metrics_statements += 1
+
+
+def _start_request():
+    """Remembers when the request started."""
+    flask.g.metrics_start = timeit.default_timer()
+    flask.g.metrics_statements = 0
+
+
+def _finish_request(response):
+    """Records the metrics of a response."""
+    start = getattr(flask.g, 'metrics_start', None)
+    if start is None:
+        return response
+    endpoint = _endpoint()
+    method = flask.request.method
+    REQUEST_LATENCY.observe((endpoint, method),
+                            timeit.default_timer() - start)
+    REQUESTS.inc((endpoint, method, str(response.status_code)))
+    if response.content_length is not None:
+        RESPONSE_SIZE.observe((endpoint,), response.content_length)
+    REQUEST_STATEMENTS.observe((endpoint,), flask.g.metrics_statements)
+    return response
+
+
+def _count_error(exception=None):
+    """Counts the requests that failed with an exception.
+
+    They get no response, so they are not seen by _finish_request.
+    """
+    if exception is not None and hasattr(flask.g, 'metrics_start'):
+        REQUESTS.inc((_endpoint(), flask.request.method, '500'))
+
+
+def _escape(value):
+    """Escapes a label value."""
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def render():
+    """Returns all the metrics in the Prometheus text format."""
+    lines = []
+    for name, value in sorted(page_cache.stats().items()):
+        if name == 'pages':
+            name, kind = 'catalog_page_cache_pages', 'gauge'
+        else:
+            name, kind = 'catalog_page_cache_%s_total' % name, 'counter'
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.append('%s %s' % (name, value))
+    for metric in METRICS:
+        lines.append('# HELP %s %s' % (metric.name, metric.description))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for suffix, labels, value in metric.samples():
+            label_text = ','.join('%s="%s"' % (name, _escape(label))
+                                  for name, label in labels)
+            lines.append('%s%s{%s} %s' % (metric.name, suffix, label_text,
+                                          repr(float(value))))
+    return u'\n'.join(lines) + u'\n'
+
+
+def init_app(app):
+    """Registers the hooks that record the metrics, and the /metrics route.
+
+    Must be called before the first template is loaded.
+
+    Args:
+        app: The flask application.
+    """
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_count_error)
+    sqla.event.listen(sqla.engine.Engine, 'before_cursor_execute',
+                      _before_cursor_execute)
+    sqla.event.listen(sqla.engine.Engine, 'after_cursor_execute',
+                      _after_cursor_execute)
+
+    @app.route('/metrics')
+    def show_metrics():
+        """Shows the metrics of this process."""
+        return flask.Response(render(), content_type=CONTENT_TYPE)
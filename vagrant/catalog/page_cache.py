@@ -0,0 +1,237 @@
+# coding: utf-8
+"""Cache of the html pages shown to anonymous visitors.
+
+Pages are kept in a bounded in-memory LRU with a time to live. When
+config.PAGE_CACHE_DIR is set, they are also stored in a directory shared by
+all the processes. Every page has a tag, and the controllers that modify the
+catalog invalidate the tags of the pages that changed.
+
+Every tag has a version counter in the versions table, bumped by the
+invalidation in the transaction of the change, so it reaches all the
+processes. A page is only served while its tag keeps the version that it was
+rendered with. Serving a page reads the versions of its tag and of all the
+pages, not the ones of the rest of the catalog.
+"""
+
+import collections
+import functools
+import hashlib
+import json
+import threading
+
+import flask
+from werkzeug.contrib import cache
+
+import conditional
+import config
+import database
+import lru
+
+# Stands for the login state of the visitor inside the cached pages.
+STATE_PLACEHOLDER = '<!--login-state-->'
+
+# Headers of the original response that are sent with the cached page.
+CACHED_HEADERS = ['Content-Type', 'Last-Modified']
+
+# Tag whose version changes when all the pages are discarded.
+ALL_PAGES = '*'
+
+CachedPage = collections.namedtuple('CachedPage', [
+    'data', 'headers', 'content_etag', 'tag', 'versions'
+])
+
+
+_pages = lru.LRUCache(config.PAGE_CACHE_SIZE, config.PAGE_CACHE_TTL)
+_shared = None
+if config.PAGE_CACHE_DIR:
+    _shared = cache.FileSystemCache(config.PAGE_CACHE_DIR,
+                                    threshold=config.PAGE_CACHE_SIZE,
+                                    default_timeout=config.PAGE_CACHE_TTL)
+_stats = collections.Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    """Increments one of the statistics of the cache."""
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _version_name(tag):
+    """Returns the name of the version counter of a tag.
+
+    The tags have the names of the categories, longer than the names of the
+    counters, so they are hashed.
+    """
+    return 'page:%s' % hashlib.sha1(tag.encode('utf-8')).hexdigest()
+
+
+def _versions(tag):
+    """Returns the versions of all the pages and of the pages of a tag.
+
+    Both are read with a single query, before the page is rendered, so a
+    change made meanwhile by another process makes the stored page outdated.
+    """
+    names = [_version_name(ALL_PAGES), _version_name(tag)]
+    values = dict(database.get_read_session().query(
+        database.Version.name, database.Version.value
+    ).filter(database.Version.name.in_(names)))
+    return tuple(values.get(name, 0) for name in names)
+
+
+def _shared_key(path, query_string, versions):
+    """Returns the key of a page in the shared cache."""
+    return 'page:%d:%d:%s?%s' % (versions + (path, query_string))
+
+
+def _lookup(key, versions):
+    """Looks for a page in the local and the shared caches.
+
+    Args:
+        key: Path and query string of the page.
+        versions: Current versions of the page, returned by _versions.
+    """
+    page = _pages.get(key)
+    if page is not None and page.versions == versions:
+        return page
+    if _shared is None:
+        return None
+    page = _shared.get(_shared_key(key[0], key[1], versions))
+    if page is not None:
+        _pages.set(key, page)
+    return page
+
+
+def _store(key, tag, versions, response):
+    """Saves a rendered page in the local and the shared caches."""
+    state = flask.session.get('state')
+    data = response.get_data()
+    if state:
+        data = data.replace(state, STATE_PLACEHOLDER)
+    headers = [(name, response.headers[name]) for name in CACHED_HEADERS
+               if name in response.headers]
+    page = CachedPage(data, headers, getattr(flask.g, 'content_etag', None),
+                      tag, versions)
+    _pages.set(key, page)
+    if _shared is not None:
+        _shared.set(_shared_key(key[0], key[1], versions), page)
+
+
+def _serve(page):
+    """Builds the response for a cached page."""
+    etag = None
+    if page.content_etag is not None:
+        etag = conditional.session_etag(page.content_etag)
+        response = conditional.not_modified(etag)
+        if response is not None:
+            return response
+    data = page.data.replace(STATE_PLACEHOLDER,
+                             flask.session.get('state', ''))
+    response = flask.Response(data, headers=page.headers)
+    if etag is not None:
+        response.set_etag(etag)
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+
+def cached(tag, before=None):
+    """Decorator that caches the pages of a controller for anonymous users.
+
+    Args:
+        tag: Format string with the tag of the pages. It is formatted with the
+            arguments of the controller.
+        before: Function called before looking for the page, even when the
+            controller is not called.
+
+    Returns:
+        The decorator.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if before is not None:
+                before()
+            if (not config.PAGE_CACHE_ENABLED or
+                    flask.request.method != 'GET' or
+                    flask.session.get('credentials')):
+                return view(*args, **kwargs)
+
+            key = (flask.request.path, flask.request.query_string)
+            page_tag = tag.format(**kwargs)
+            versions = _versions(page_tag)
+            page = _lookup(key, versions)
+            if page is not None:
+                _count('hits')
+                return _serve(page)
+
+            _count('misses')
+            response = flask.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                _store(key, page_tag, versions, response)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+def item_tags(item):
+    """Returns the tags of the pages that show an item."""
+    return ('recent', 'category:%s' % item.category.name, 'item:%d' % item.id)
+
+
+def invalidate(db_session, *tags):
+    """Discards the cached pages with any of the tags, in every process.
+
+    Must be called before commiting the session that modifies the pages, so
+    the change and the new versions of the tags are saved together.
+
+    Args:
+        db_session: The database session.
+        tags: Tags of the pages that changed.
+    """
+    tags = set(tags)
+    for tag in tags:
+        database.bump_version(db_session, _version_name(tag))
+    _pages.delete_if(lambda page: page.tag in tags)
+    _count('invalidations')
+
+
+def clear(db_session):
+    """Discards all the cached pages, in every process.
+
+    Must be called before commiting the session, like invalidate.
+
+    Args:
+        db_session: The database session.
+    """
+    database.bump_version(db_session, _version_name(ALL_PAGES))
+    _pages.clear()
+    _count('invalidations')
+
+
+def stats():
+    """Returns the statistics of the cache.
+
+    Returns:
+        A dictionary with the number of hits, misses and invalidations, and
+        the number of pages in the local cache.
+    """
+    with _stats_lock:
+        values = dict(hits=0, misses=0, invalidations=0)
+        values.update(_stats)
+    values['pages'] = len(_pages)
+    return values
+
+
+def load_controllers(app):
+    """Defines the routes of the page cache.
+
+    Args:
+        app: The flask application.
+    """
+
+    @app.route('/cache.json')
+    def page_cache_stats():
+        """Shows the statistics of the page cache of this process."""
+        return flask.Response(json.dumps(stats()),
+                              mimetype='application/json')
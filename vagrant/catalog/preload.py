@@ -0,0 +1,193 @@
+# coding: utf-8
+"""Preloading of the application for WSGI servers that fork their workers.
+
+preload() imports the application, compiles every template and fills the
+in-memory caches in the master process, so the forked workers answer their
+first request without that work. Before the workers are forked it closes the
+database connections, and after_fork() discards in each worker the state
+that can't be shared with the master: connections and thread pools.
+
+With uWSGI, myapp.wsgi calls preload() and the postfork hook is registered
+when uwsgidecorators is available. With gunicorn, this file is also its
+configuration:
+
+    gunicorn --preload -c preload.py 'application:app'
+
+The time to the first response of a forked worker, with and without the
+preloading, is measured with:
+
+    python preload.py --measure
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import timeit
+
+try:
+    import uwsgidecorators
+except ImportError:
+    uwsgidecorators = None
+
+# Pages requested by the workers in the measures.
+MEASURED_URLS = ['/', '/catalog.json']
+
+
+def load_templates(app):
+    """Compiles every template, keeping them in the cache of jinja.
+
+    Returns:
+        The number of templates.
+    """
+    # The loader of the precompiled templates can't list them.
+    names = app.create_global_jinja_loader().list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def warm(app):
+    """Fills the in-memory caches that every request uses."""
+    import category_cache
+    import database
+    import recent_items
+    import search
+    import static_files
+
+    with app.app_context():
+        db_session = database.get_session()
+        recent_items.warm(db_session)
+        category_cache.get_categories(db_session)
+        # Finds if the database has the full text index.
+        search.search_items(db_session, 'catalog', size=1)
+        static_files.fingerprint('css/main.css')
+
+
+def preload():
+    """Prepares the application in the master process.
+
+    Returns:
+        The flask application.
+    """
+    import application
+    import database
+
+    load_templates(application.app)
+    warm(application.app)
+    database.dispose_engines()
+    if uwsgidecorators is not None:
+        uwsgidecorators.postfork(after_fork)
+    return application.app
+
+
+def after_fork():
+    """Discards in a new worker the state inherited from the master."""
+    import application
+    import database
+    import file_upload
+    import login
+    import thumbnails
+
+    database.dispose_engines()
+    database.remove_session()
+    application.app.session_interface.store.reset()
+    for module in (file_upload, login, thumbnails):
+        module.reset_after_fork()
+
+
+def when_ready(server):
+    """Hook of gunicorn, called in the master before forking the workers."""
+    preload()
+
+
+def post_fork(server, worker):
+    """Hook of gunicorn, called in each new worker."""
+    after_fork()
+
+
+def first_response(preloaded):
+    """Forks a worker and measures the time to its first responses.
+
+    Without preloading the worker imports the application itself, like the
+    workers of a server that doesn't preload.
+
+    Args:
+        preloaded: Whether the application is preloaded before forking.
+
+    Returns:
+        The seconds from the fork until the worker answered every url of
+        MEASURED_URLS.
+    """
+    if preloaded:
+        preload()
+    read_end, write_end = os.pipe()
+    start = timeit.default_timer()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        if preloaded:
+            after_fork()
+        import application
+        client = application.app.test_client()
+        for url in MEASURED_URLS:
+            client.get(url).data
+        os.write(write_end, repr(timeit.default_timer() - start))
+        os._exit(0)
+    os.close(write_end)
+    elapsed = os.read(read_end, 64)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    if not elapsed:
+        raise RuntimeError('the worker failed before responding')
+    return float(elapsed)
+
+
+def median_first_response(mode, repeat):
+    """Measures the time to the first response of new workers.
+
+    Every measure runs in a new python process, so nothing is imported
+    before it starts.
+
+    Args:
+        mode: 'cold' or 'preloaded'.
+        repeat: Number of measures.
+
+    Returns:
+        The median of the seconds to the first responses.
+    """
+    times = sorted(
+        float(subprocess.check_output([sys.executable, __file__,
+                                       '--first-response', mode]))
+        for _ in xrange(repeat)
+    )
+    return times[len(times) // 2]
+
+
+def measure(repeat):
+    """Prints the time to the first response, with and without preloading."""
+    for mode in ('cold', 'preloaded'):
+        print '%-10s first response in %7.1f ms (median of %d)' % (
+            mode, median_first_response(mode, repeat) * 1000, repeat
+        )
+
+
+def main(arguments):
+    """Runs the measures from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--measure', action='store_true',
+                        help='compare the first response of new workers')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--first-response', choices=['cold', 'preloaded'],
+                        help=argparse.SUPPRESS)
+    options = parser.parse_args(arguments)
+    if options.first_response:
+        print repr(first_response(options.first_response == 'preloaded'))
+    elif options.measure:
+        measure(options.repeat)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
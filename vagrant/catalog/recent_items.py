@@ -0,0 +1,182 @@
+# coding: utf-8
+"""In-process index of the most recently added items.
+
+The home page and the Atom feed read the index instead of querying the
+items. It keeps small records with the fields that they show, and it is
+updated by the item controllers after they commit. Like the category cache,
+every process compares its index with the 'recent' version counter, and
+reloads it when another process modified the items.
+"""
+
+import collections
+import threading
+
+import sqlalchemy as sqla
+
+import config
+import database
+
+VERSION = 'recent'
+
+# Maximum number of rendered feeds kept, one for each feed url.
+MAX_FEEDS = 16
+
+RecentItem = collections.namedtuple('RecentItem', [
+    'id', 'name', 'category_name', 'image', 'thumbnail', 'datetime',
+    'description'
+])
+
+_lock = threading.RLock()
+_version = None
+_items = []
+_feeds = {}
+
+
+def _sort_key(record):
+    """Sorts the records from the most recent to the oldest."""
+    return record.datetime, record.id
+
+
+def _load(db_session, version):
+    """Reads the most recent items from the database."""
+    global _version, _items
+    rows = db_session.query(
+        database.Item.id, database.Item.name, database.Category.name,
+        database.Item.image, database.Item.thumbnail, database.Item.datetime,
+        database.Item.description
+    ).join(
+        # Explicit, since this runs on import, maybe before the backref
+        # Item.category is created.
+        database.Category, database.Item.category_id == database.Category.id
+    ).order_by(
+        database.Item.datetime.desc(), database.Item.id.desc()
+    ).limit(config.RECENT_ITEMS_SIZE)
+    with _lock:
+        _items = [RecentItem(*row) for row in rows]
+        _version = version
+        _feeds.clear()
+
+
+def _refresh(db_session):
+    """Reloads the index if the items were modified by another process."""
+    version = database.get_version(db_session, VERSION)
+    if version != _version:
+        _load(db_session, version)
+
+
+def warm(db_session):
+    """Loads the index before the first request needs it.
+
+    Args:
+        db_session: The database session.
+    """
+    try:
+        _refresh(db_session)
+    except sqla.exc.DBAPIError:
+        # The database is not created yet, it will be loaded on first use.
+        # PostgreSQL aborts the transaction of the failed query.
+        db_session.rollback()
+
+
+def get_items(db_session, count):
+    """Returns the most recent items.
+
+    Args:
+        db_session: The database session.
+        count: Number of items, at most config.RECENT_ITEMS_SIZE.
+
+    Returns:
+        A list of RecentItem, from the most recent.
+    """
+    _refresh(db_session)
+    return _items[:count]
+
+
+def get_feed(db_session, key, render):
+    """Returns a feed of the recent items, cached until they change.
+
+    Args:
+        db_session: The database session.
+        key: Identifies the feed, usually its url.
+        render: Function that receives the records of the recent items and
+            returns the feed.
+
+    Returns:
+        The rendered feed.
+    """
+    _refresh(db_session)
+    with _lock:
+        feed = _feeds.get(key)
+        if feed is None:
+            feed = render(list(_items))
+            if len(_feeds) >= MAX_FEEDS:
+                _feeds.clear()
+            _feeds[key] = feed
+        return feed
+
+
+def changed(db_session):
+    """Marks the recent items as modified.
+
+    Must be called before commiting the session that modifies the items.
+
+    Args:
+        db_session: The database session.
+
+    Returns:
+        The new version of the recent items, that must be given to
+        item_saved or item_deleted after the commit.
+    """
+    return database.bump_version(db_session, VERSION)
+
+
+def _apply(version, update):
+    """Applies a change to the index if it is the only change since it was
+    loaded, or marks it to be reloaded otherwise."""
+    global _version, _items
+    with _lock:
+        if _version is None or version != _version + 1:
+            _version = None
+            return
+        _items = update(list(_items))
+        _version = version
+        _feeds.clear()
+
+
+def item_saved(item, version):
+    """Updates the index with a new or modified item.
+
+    Args:
+        item: The commited item.
+        version: Value returned by changed().
+    """
+    record = RecentItem(item.id, item.name, item.category.name, item.image,
+                        item.thumbnail, item.datetime, item.description)
+
+    def update(items):
+        items = [other for other in items if other.id != record.id]
+        full = len(items) >= config.RECENT_ITEMS_SIZE
+        if not full or _sort_key(record) > _sort_key(items[-1]):
+            items.append(record)
+            items.sort(key=_sort_key, reverse=True)
+        return items[:config.RECENT_ITEMS_SIZE]
+
+    _apply(version, update)
+
+
+def item_deleted(item_id, version):
+    """Removes an item from the index.
+
+    If the item was in the index, it is reloaded to find the item that takes
+    its place.
+
+    Args:
+        item_id: Id of the deleted item.
+        version: Value returned by changed().
+    """
+    global _version
+    with _lock:
+        if any(record.id == item_id for record in _items):
+            _version = None
+        else:
+            _apply(version, lambda items: items)
@@ -0,0 +1,218 @@
+# coding: utf-8
+"""Full text search of the catalog items.
+
+On sqlite the items are searched in the FTS5 index created by the database
+migrations, and sorted by relevance with bm25, where the name weighs more
+than the description. Without the index, the words are looked up with LIKE
+and the items are sorted by id.
+
+Every word of the query must be in the item. A word that ends with * matches
+all the words that start with it.
+"""
+
+import json
+import re
+
+import flask
+import sqlalchemy as sqla
+
+import catalog
+import category_cache
+import config
+import database
+
+WORD = re.compile(r'(\w+)(\*?)', re.UNICODE)
+
+# Relative weights of the name and the description in the ranking.
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+
+_indexed = None
+
+
+def _parse_query(text):
+    """Splits the query in (word, is_prefix) pairs."""
+    return [(word, bool(star)) for word, star in WORD.findall(text)]
+
+
+def _match_expression(words):
+    """Builds the FTS5 expression of a query.
+
+    Every word is quoted, so the characters with a meaning in the FTS5 syntax
+    are searched as text.
+    """
+    return ' '.join('"%s"%s' % (word, '*' if prefix else '')
+                    for word, prefix in words)
+
+
+def _parse_cursor(cursor):
+    """Reads the (rank, id) of the item before the page.
+
+    Raises:
+        ValueError: The cursor is not valid.
+    """
+    rank, item_id = cursor.split(':')
+    return float(rank), int(item_id)
+
+
+def _uses_index(db_session):
+    """Returns true if the database has the full text index."""
+    global _indexed
+    if _indexed is None:
+        _indexed = database.has_search_index(db_session.connection())
+    return _indexed
+
+
+def _indexed_search(db_session, words, category, after, limit):
+    """Returns the (id, rank) rows of the matching items, using the index."""
+    conditions = []
+    params = dict(query=_match_expression(words), limit=limit,
+                  name_weight=NAME_WEIGHT,
+                  description_weight=DESCRIPTION_WEIGHT)
+    if category is not None:
+        conditions.append('catalog.category_id = :category_id')
+        params['category_id'] = category.id
+    keyset = ''
+    if after is not None:
+        keyset = ('WHERE rank > :after_rank OR '
+                  '(rank = :after_rank AND id > :after_id)')
+        params['after_rank'], params['after_id'] = after
+    statement = sqla.text(
+        'SELECT id, rank FROM ('
+        'SELECT catalog.id AS id, '
+        'bm25({0}, :name_weight, :description_weight) AS rank '
+        'FROM {0} JOIN catalog ON catalog.id = {0}.rowid '
+        'WHERE {0} MATCH :query {1}) {2} '
+        'ORDER BY rank, id LIMIT :limit'.format(
+            database.SEARCH_TABLE,
+            ''.join(' AND %s' % condition for condition in conditions),
+            keyset
+        )
+    )
+    return db_session.execute(statement, params).fetchall()
+
+
+def _unindexed_search(db_session, words, category, after, limit):
+    """Returns the (id, rank) rows of the matching items, without index."""
+    query = db_session.query(database.Item.id, sqla.literal(0.0, sqla.Float))
+    for word, _ in words:
+        pattern = '%%%s%%' % word
+        query = query.filter(sqla.or_(
+            database.Item.name.ilike(pattern),
+            database.Item.description.ilike(pattern)
+        ))
+    if category is not None:
+        query = query.filter(database.Item.category_id == category.id)
+    if after is not None:
+        query = query.filter(database.Item.id > after[1])
+    return query.order_by(database.Item.id).limit(limit).all()
+
+
+def search_items(db_session, text, category=None, after=None, size=None):
+    """Searches the items that contain all the words of a query.
+
+    Args:
+        db_session: The database session.
+        text: The query.
+        category: Only search the items of this category.
+        after: Cursor returned with the previous page.
+        size: Number of items in each page, by default
+            config.SEARCH_PAGE_SIZE.
+
+    Returns:
+        A tuple with the list of items, sorted from the most relevant, and
+        the cursor of the next page, or None if it is the last page.
+
+    Raises:
+        ValueError: The cursor is not valid.
+    """
+    size = size or config.SEARCH_PAGE_SIZE
+    words = _parse_query(text)
+    if not words:
+        return [], None
+    if after is not None:
+        after = _parse_cursor(after)
+    if _uses_index(db_session):
+        rows = _indexed_search(db_session, words, category, after, size + 1)
+    else:
+        rows = _unindexed_search(db_session, words, category, after, size + 1)
+
+    following = None
+    if len(rows) > size:
+        rows = rows[:size]
+        following = '%r:%d' % (rows[-1][1], rows[-1][0])
+    ids = [row[0] for row in rows]
+    if not ids:
+        return [], None
+    items = db_session.query(database.Item).options(
+        database.with_category()
+    ).filter(database.Item.id.in_(ids)).all()
+    items.sort(key=lambda item: ids.index(item.id))
+    return items, following
+
+
+def _search_arguments(db_session):
+    """Reads the query, the category and the cursor of a search request."""
+    text = flask.request.args.get('q', '')
+    category = None
+    category_name = flask.request.args.get('category')
+    if category_name:
+        category = db_session.query(database.Category).filter(
+            database.Category.name == category_name
+        ).first()
+        if category is None:
+            flask.abort(404)
+    try:
+        items, following = search_items(db_session, text, category,
+                                        flask.request.args.get('after'))
+    except ValueError:
+        flask.abort(400)
+    return text, category, items, following
+
+
+def load_controllers(app):
+    """Defines the search routes.
+
+    Args:
+        app: The flask application.
+    """
+
+    @app.route('/search')
+    def search():
+        """Shows the items that match the q argument.
+
+        The category argument limits the search to a category, and the after
+        argument has the cursor of the page.
+
+        Returns:
+            Html with the items found.
+        """
+        db_session = database.get_read_session()
+        catalog.prepare_login()
+        categories = category_cache.get_categories(db_session)
+        text, category, items, following = _search_arguments(db_session)
+        return flask.render_template('search.html', categories=categories,
+                                     query=text, category=category,
+                                     items=items, following=following)
+
+    @app.route('/search.json')
+    def search_json():
+        """Returns the items that match the q argument, as JSON.
+
+        Returns:
+            JSON with the items found, and the cursor of the next page.
+        """
+        db_session = database.get_read_session()
+        text, category, items, following = _search_arguments(db_session)
+        if not text.strip():
+            flask.abort(400)
+        results = []
+        for item in items:
+            result = item.get_json()
+            result['category'] = item.category.name
+            results.append(result)
+        return flask.Response(json.dumps({
+            'query': text,
+            'items': results,
+            'next': following
+        }), mimetype='application/json')
@@ -0,0 +1,103 @@
+# coding: utf-8
+"""Serialization of the items read as rows, without building ORM objects.
+
+The fields of the items can be chosen with the fields argument of the query
+string, and only the columns of those fields are read from the database.
+The responses are JSON, or MessagePack when the client prefers it in the
+Accept header and the msgpack package is installed.
+"""
+
+import collections
+import datetime
+import json
+
+import flask
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import database
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+
+# Fields sent when the request doesn't choose them, like Item.get_json.
+DEFAULT_FIELDS = ['id', 'name', 'description', 'image']
+
+# Columns of the fields that can be requested.
+COLUMNS = collections.OrderedDict([
+    ('id', database.Item.id),
+    ('name', database.Item.name),
+    ('description', database.Item.description),
+    ('image', database.Item.image),
+    ('thumbnail', database.Item.thumbnail),
+    ('detail_image', database.Item.detail_image),
+    ('category', database.Category.name),
+    ('datetime', database.Item.datetime),
+    ('updated', database.Item.updated),
+])
+
+
+def requested_fields():
+    """Reads the fields argument of the query string.
+
+    Aborts with 400 when it has an unknown field.
+
+    Returns:
+        The list of field names, without repetitions.
+    """
+    value = flask.request.args.get('fields')
+    if value is None:
+        return DEFAULT_FIELDS
+    fields = []
+    for field in value.split(','):
+        field = field.strip()
+        if field not in COLUMNS:
+            flask.abort(400)
+        if field not in fields:
+            fields.append(field)
+    return fields
+
+
+def select_columns(fields):
+    """Returns the labeled columns that read the fields."""
+    return [COLUMNS[field].label(field) for field in fields]
+
+
+def to_record(row, fields):
+    """Converts a row read with select_columns to a dictionary."""
+    record = {}
+    for field, value in zip(fields, row):
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        record[field] = value
+    return record
+
+
+def response_mimetype():
+    """Returns the format preferred by the client, JSON by default."""
+    offered = [JSON, MSGPACK] if msgpack is not None else [JSON]
+    return flask.request.accept_mimetypes.best_match(offered, default=JSON)
+
+
+def make_response(value, mimetype):
+    """Serializes a value in the chosen format.
+
+    Args:
+        value: Lists, dictionaries and scalars.
+        mimetype: Value returned by response_mimetype.
+
+    Returns:
+        The response, that varies with the Accept header.
+    """
+    if mimetype == MSGPACK:
+        # The keys are byte strings in python 2, and must also be sent with
+        # the string type.
+        data = msgpack.packb(value, use_bin_type=False)
+    else:
+        data = json.dumps(value)
+    response = flask.Response(data, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
@@ -0,0 +1,242 @@
+# coding: utf-8
+"""Sessions saved in the server, with a small opaque cookie.
+
+The cookie only has a random session id and the revision of the session. The
+sessions are saved in an sqlite database shared by all the processes, and
+every process keeps the recently used ones in memory. The revision of the
+cookie tells when the copy in memory is older than the saved one, because
+another process changed the session.
+
+The sessions of the visitors that didn't log in only have the values of
+config.SESSION_COOKIE_KEYS, like the CSRF token, and they are kept in a
+signed cookie instead, so crawlers don't fill the database. A session gets a
+new id when it moves to the database, and when the user logs in or out.
+
+Requests that don't change the values of the session don't write anything:
+neither the database nor the cookie. The expired sessions are deleted from
+time to time, when a session is saved.
+"""
+
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from flask import sessions
+import itsdangerous
+from werkzeug import datastructures
+
+import config
+import lru
+
+
+class ServerSession(datastructures.CallbackDict, sessions.SessionMixin):
+    """Session whose values are saved in the server.
+
+    Attributes:
+        sid: Random id of the session, None if it is new.
+        revision: Number of times that the session was saved.
+        expires: Time when the saved session expires.
+        saved: Serialized values of the saved session, None if it is new.
+        regenerated: Whether the session moves to a new id when it is saved.
+    """
+
+    def __init__(self, initial=None, sid=None, revision=0, expires=0,
+                 saved=None):
+        def on_update(session):
+            session.modified = True
+        datastructures.CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.revision = revision
+        self.expires = expires
+        self.saved = saved
+        self.regenerated = False
+        self.modified = False
+
+    def regenerate(self):
+        """Moves the session to a new id, so the old one can't be used."""
+        self.regenerated = True
+        self.modified = True
+
+
+def _in_cookie(session):
+    """Checks if the values of a session are kept in the cookie."""
+    return set(session) <= config.SESSION_COOKIE_KEYS
+
+
+class SessionStore(object):
+    """Sessions saved in an sqlite database.
+
+    Each thread has its own connection to the database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        """Returns the connection of the current thread."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                               'sid TEXT PRIMARY KEY, revision INTEGER, '
+                               'data TEXT, expires REAL)')
+            self._local.connection = connection
+        return connection
+
+    def reset(self):
+        """Forgets the connections, that a forked process must not use."""
+        self._local = threading.local()
+
+    def load(self, sid):
+        """Returns the (revision, data, expires) of a session, or None."""
+        return self._connection().execute(
+            'SELECT revision, data, expires FROM sessions WHERE sid = ?',
+            (sid,)
+        ).fetchone()
+
+    def save(self, sid, revision, data, expires):
+        """Saves a session."""
+        self._connection().execute(
+            'INSERT OR REPLACE INTO sessions (sid, revision, data, expires) '
+            'VALUES (?, ?, ?, ?)', (sid, revision, data, expires)
+        )
+
+    def touch(self, sid, expires):
+        """Changes the expiration time of a session."""
+        self._connection().execute(
+            'UPDATE sessions SET expires = ? WHERE sid = ?', (expires, sid)
+        )
+
+    def delete(self, sid):
+        """Deletes a session."""
+        self._connection().execute('DELETE FROM sessions WHERE sid = ?',
+                                   (sid,))
+
+    def sweep(self, now):
+        """Deletes the expired sessions."""
+        self._connection().execute('DELETE FROM sessions WHERE expires < ?',
+                                   (now,))
+
+
+class ServerSessionInterface(sessions.SessionInterface):
+    """Opens and saves the sessions kept in a SessionStore."""
+
+    serializer = sessions.session_json_serializer
+    session_class = ServerSession
+
+    def __init__(self, store):
+        self.store = store
+        self._recent = lru.LRUCache(config.SESSION_MEMORY_SIZE,
+                                    config.SESSION_TTL)
+
+    def _load(self, sid, revision):
+        """Returns the saved (revision, data, expires) of a session.
+
+        The copy in memory is used when it has the revision of the cookie.
+        Another process may have extended the expiration, so the saved
+        session is read when the copy seems expired.
+        """
+        entry = self._recent.get(sid)
+        if entry is None or entry[0] != revision or entry[2] <= time.time():
+            entry = self.store.load(sid)
+            if entry is not None:
+                self._recent.set(sid, tuple(entry))
+        return entry
+
+    def _signer(self, app):
+        """Returns the serializer of the sessions kept in the cookie."""
+        return itsdangerous.URLSafeTimedSerializer(
+            app.secret_key, salt='server-session', serializer=self.serializer
+        )
+
+    def _set_cookie(self, app, session, response, value):
+        """Sends the session cookie."""
+        response.set_cookie(app.session_cookie_name, value,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=self.get_cookie_domain(app),
+                            path=self.get_cookie_path(app),
+                            secure=self.get_cookie_secure(app))
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(app.session_cookie_name, '')
+        sid, _, revision = cookie.partition('.')
+        if sid and revision.isdigit():
+            entry = self._load(sid, int(revision))
+            if entry is not None and entry[2] > time.time():
+                return self.session_class(self.serializer.loads(entry[1]),
+                                          sid, entry[0], entry[2], entry[1])
+        elif cookie:
+            try:
+                values = self._signer(app).loads(cookie,
+                                                 max_age=config.SESSION_TTL)
+            except itsdangerous.BadSignature:
+                pass
+            else:
+                return self.session_class(
+                    values, saved=self.serializer.dumps(values)
+                )
+        return self.session_class()
+
+    def save_session(self, app, session, response):
+        now = time.time()
+        data = None
+        if session.modified and session:
+            # Values set again to the same value, like the CSRF token on
+            # every request, don't change the saved session.
+            data = self.serializer.dumps(dict(session))
+            if data == session.saved and not session.regenerated:
+                session.modified = False
+        if not session.modified:
+            # The expiration is only moved when half of it has passed, so
+            # the requests that read the session rarely write.
+            if session.sid and session.expires - now < config.SESSION_TTL / 2:
+                session.expires = now + config.SESSION_TTL
+                self.store.touch(session.sid, session.expires)
+                self._recent.delete(session.sid)
+            return
+        if session.sid is not None and (session.regenerated or
+                                        _in_cookie(session)):
+            self.store.delete(session.sid)
+            self._recent.delete(session.sid)
+            session.sid = None
+            session.revision = 0
+        session.saved = data
+        if not session:
+            response.delete_cookie(app.session_cookie_name,
+                                   domain=self.get_cookie_domain(app),
+                                   path=self.get_cookie_path(app))
+            return
+        if _in_cookie(session):
+            self._set_cookie(app, session, response,
+                             self._signer(app).dumps(dict(session)))
+            return
+
+        if session.sid is None:
+            session.sid = os.urandom(24).encode('hex')
+        session.revision += 1
+        session.expires = now + config.SESSION_TTL
+        self.store.save(session.sid, session.revision, data, session.expires)
+        self._recent.set(session.sid,
+                         (session.revision, data, session.expires))
+        if random.random() < config.SESSION_SWEEP_PROBABILITY:
+            self.store.sweep(now)
+        self._set_cookie(app, session, response,
+                         '%s.%d' % (session.sid, session.revision))
+
+
+def init_app(app):
+    """Makes the application save the sessions in the server.
+
+    Args:
+        app: The flask application.
+    """
+    app.session_interface = ServerSessionInterface(
+        SessionStore(config.SESSION_DATABASE)
+    )
@@ -0,0 +1,159 @@
+# coding: utf-8
+"""Functions that serve the static and uploaded files.
+
+Files with a fingerprint in their url never change, so browsers can keep
+them forever without asking again. The rest of the files are revalidated
+with their ETag. Range requests are answered with partial content.
+
+With config.SENDFILE_MODE the bytes are not sent by python. In 'x-sendfile'
+mode the response has an X-Sendfile header with the path of the file (Apache
+mod_xsendfile, lighttpd). In 'x-accel-redirect' mode it has an
+X-Accel-Redirect header with the file under config.ACCEL_REDIRECT_PREFIX,
+which must be an internal location of nginx.
+"""
+
+import hashlib
+import mimetypes
+import os
+import posixpath
+import threading
+
+import flask
+
+import config
+
+# Bytes read at a time while a range is sent.
+CHUNK_SIZE = 64 * 1024
+
+_fingerprints = {}
+_lock = threading.Lock()
+
+
+def fingerprint(path):
+    """Returns a short hash of the contents of a file.
+
+    The hash is computed again only when the file is modified.
+
+    Args:
+        path: Path of the file, relative to the application.
+
+    Returns:
+        The hash of the file.
+    """
+    full_path = os.path.join(flask.current_app.root_path, path)
+    mtime = os.path.getmtime(full_path)
+    with _lock:
+        cached = _fingerprints.get(full_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(full_path, 'rb') as static_file:
+        value = hashlib.sha1(static_file.read()).hexdigest()[:12]
+    with _lock:
+        _fingerprints[full_path] = (mtime, value)
+    return value
+
+
+def static_url(path):
+    """Returns the url of a static file with its fingerprint.
+
+    Args:
+        path: Path of the file, relative to the application.
+    """
+    return '%s/%s?v=%s' % (flask.request.script_root, path, fingerprint(path))
+
+
+def send_file(directory, filename, immutable=False):
+    """Sends a file with the headers that allow caching it.
+
+    Args:
+        directory: Directory of the file, relative to the application.
+        filename: Name of the file.
+        immutable: True if the url of the file changes when it is modified.
+
+    Returns:
+        The response with the file.
+    """
+    path = flask.safe_join(
+        os.path.join(flask.current_app.root_path, directory), filename
+    )
+    if not os.path.isfile(path):
+        flask.abort(404)
+    max_age = config.STATIC_MAX_AGE if immutable else 0
+
+    if config.SENDFILE_MODE == 'x-accel-redirect':
+        response = flask.Response(mimetype=mimetypes.guess_type(path)[0])
+        response.headers['X-Accel-Redirect'] = posixpath.join(
+            config.ACCEL_REDIRECT_PREFIX, directory, filename
+        )
+    else:
+        response = flask.send_file(path, cache_timeout=max_age,
+                                   conditional=True)
+        if not flask.current_app.use_x_sendfile:
+            response.headers['Accept-Ranges'] = 'bytes'
+            if response.status_code == 200 and flask.request.range:
+                response = _send_range(path, response)
+
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if immutable:
+        response.cache_control['immutable'] = None
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def _send_range(path, response):
+    """Replaces a full response with the range asked by the client.
+
+    Args:
+        path: Path of the file.
+        response: The full response of the file.
+
+    Returns:
+        A partial content response, or the full response if the range is for
+        an older version of the file.
+    """
+    if_range = flask.request.if_range
+    if if_range.etag and if_range.etag != response.get_etag()[0]:
+        return response
+    size = os.path.getsize(path)
+    bounds = flask.request.range.range_for_length(size)
+    response.close()
+    if bounds is None:
+        partial = flask.Response(status=416)
+        partial.headers['Content-Range'] = 'bytes */%d' % size
+        return partial
+
+    start, stop = bounds
+    partial = flask.Response(_read_range(path, start, stop), status=206,
+                             mimetype=response.mimetype,
+                             direct_passthrough=True)
+    for header in ('ETag', 'Last-Modified', 'Accept-Ranges'):
+        partial.headers[header] = response.headers[header]
+    partial.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1,
+                                                           size)
+    partial.content_length = stop - start
+    return partial
+
+
+def _read_range(path, start, stop):
+    """Reads the bytes from start to stop of a file, in chunks."""
+    with open(path, 'rb') as range_file:
+        range_file.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = range_file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def init_app(app):
+    """Configures the flask application to serve the files.
+
+    Args:
+        app: The flask application.
+    """
+    app.use_x_sendfile = config.SENDFILE_MODE == 'x-sendfile'
+    app.jinja_env.globals['static_url'] = static_url
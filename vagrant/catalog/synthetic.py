@@ -0,0 +1,118 @@
+# coding: utf-8
+"""Generator of synthetic catalogs, to test the application with more data
+than the default one.
+
+The catalogs depend only on the seed, so two runs with the same arguments
+generate the same items. The records have the format of bulk.py and are
+imported with it.
+
+Usage:
+    python synthetic.py --categories 50 --items 2000 --image-ratio 0.3
+"""
+
+import argparse
+import datetime
+import hashlib
+import os
+import random
+import sys
+
+import bulk
+import file_upload
+
+WORDS = ['red', 'blue', 'green', 'small', 'large', 'old', 'new', 'wooden',
+         'metal', 'soft', 'fast', 'quiet', 'bright', 'dark', 'round',
+         'square', 'heavy', 'light', 'vintage', 'modern', 'lamp', 'chair',
+         'table', 'guitar', 'camera', 'bicycle', 'kettle', 'jacket', 'book',
+         'clock', 'bottle', 'basket', 'plant', 'mirror', 'rug', 'kite']
+
+# Number of different images shared by the items that have one.
+IMAGE_COUNT = 50
+
+# Date of the oldest item.
+START_DATE = datetime.datetime(2015, 1, 1)
+
+
+def image_data(seed, index):
+    """Returns the contents of one of the synthetic images."""
+    return hashlib.sha512('%s:%d' % (seed, index)).digest() * 16
+
+
+def image_route(seed, index):
+    """Returns the route of one of the synthetic images."""
+    digest = hashlib.sha256(image_data(seed, index)).hexdigest()
+    return '/uploads/%s.png' % digest
+
+
+def write_images(seed):
+    """Saves the synthetic images in the uploads folder.
+
+    The files are not real images, they are only used to test the routes.
+    """
+    for index in xrange(IMAGE_COUNT):
+        path = os.path.join(file_upload.upload_folder(),
+                            os.path.basename(image_route(seed, index)))
+        if not os.path.exists(path):
+            with open(path, 'wb') as image_file:
+                image_file.write(image_data(seed, index))
+
+
+def generate(categories, items, image_ratio=0.0, seed=0):
+    """Generates the records of a synthetic catalog.
+
+    Args:
+        categories: Number of categories.
+        items: Number of items of each category.
+        image_ratio: Fraction of the items that have an image.
+        seed: Seed of the random generator.
+
+    Yields:
+        The records of the items, in the format of bulk.py.
+    """
+    generator = random.Random(seed)
+    for category_index in xrange(categories):
+        category = 'Category %d' % (category_index + 1)
+        for item_index in xrange(items):
+            words = generator.sample(WORDS, 2)
+            record = {
+                'category': category,
+                'name': '%s %s %d' % (words[0].title(), words[1],
+                                      item_index + 1),
+                'description': ' '.join(generator.choice(WORDS)
+                                        for _ in xrange(12)),
+                'datetime': (START_DATE + datetime.timedelta(
+                    minutes=generator.randint(0, 500000)
+                )).isoformat(),
+            }
+            if generator.random() < image_ratio:
+                record['image'] = image_route(
+                    seed, generator.randint(0, IMAGE_COUNT - 1)
+                )
+            yield record
+
+
+def add_arguments(parser):
+    """Adds the arguments that describe a synthetic catalog to a parser."""
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--items', type=int, default=100,
+                        help='number of items of each category')
+    parser.add_argument('--image-ratio', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def main(arguments):
+    """Adds a synthetic catalog to the database."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    add_arguments(parser)
+    options = parser.parse_args(arguments)
+    if options.image_ratio:
+        write_images(options.seed)
+    stats = bulk.import_items(generate(options.categories, options.items,
+                                       options.image_ratio, options.seed))
+    print 'Generated %d items in %.2f seconds.' % (
+        stats['inserted'] + stats['updated'], stats['seconds']
+    )
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
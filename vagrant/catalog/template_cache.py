@@ -0,0 +1,179 @@
+# coding: utf-8
+"""Caches of the compiled templates.
+
+Jinja compiles every template to python code the first time a process uses
+it. The bytecode of the compiled templates is saved in TEMPLATE_CACHE_DIR,
+shared by all the processes, so a new worker loads it instead of compiling
+the templates again. The templates can also be compiled ahead of time, with
+the build command, into a folder of python modules that is imported instead.
+The folder is ignored when a template is newer than it, so an outdated build
+is never shown.
+
+Usage:
+    python template_cache.py build
+    python template_cache.py benchmark --repeat 20
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import jinja2
+
+import config
+
+# Pages rendered by the benchmark.
+BENCHMARK_URLS = ['/', '/catalog/Fruits', '/login', '/search?q=apple']
+
+
+class SharedBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """Bytecode cache whose files are replaced atomically, so a process never
+    reads a file that another one is still writing."""
+
+    def dump_bytecode(self, bucket):
+        handle, temp_path = tempfile.mkstemp(dir=self.directory,
+                                             prefix='.tmp-')
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                bucket.write_bytecode(temp_file)
+            os.rename(temp_path, self._get_cache_filename(bucket))
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+def _newest_change(folder):
+    """Returns the date of the most recently modified file of a folder."""
+    return max([os.path.getmtime(os.path.join(path, name))
+                for path, _, names in os.walk(folder) for name in names] or
+               [0])
+
+
+def bundle_is_current(app, bundle):
+    """Checks if the precompiled templates are newer than the templates.
+
+    Args:
+        app: The flask application.
+        bundle: Folder of the precompiled templates.
+    """
+    if not os.path.isdir(bundle) or not os.listdir(bundle):
+        return False
+    built = min(os.path.getmtime(os.path.join(bundle, name))
+                for name in os.listdir(bundle))
+    return built >= _newest_change(os.path.join(app.root_path,
+                                                app.template_folder))
+
+
+def build(app, target):
+    """Compiles all the templates of the application into a folder.
+
+    Args:
+        app: The flask application.
+        target: Folder of the modules, replaced if it exists.
+
+    Returns:
+        The number of compiled templates.
+    """
+    # The templates are read from their files even if a bundle is in use.
+    env = app.jinja_env.overlay(loader=app.create_global_jinja_loader(),
+                                bytecode_cache=None)
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.makedirs(target)
+    env.compile_templates(target, zip=None, ignore_errors=False,
+                          py_compile=sys.version_info[0] == 2)
+    return len(env.list_templates())
+
+
+def benchmark(app, repeat):
+    """Measures the first and the following renders of the pages.
+
+    The templates are removed from the memory of jinja before each cold
+    render, and loaded from the source files, from the bytecode cache or from
+    the precompiled bundle.
+
+    Returns:
+        A dictionary from the name of each way of loading the templates to
+        the median milliseconds of the cold and the warm renders.
+    """
+    config.PAGE_CACHE_ENABLED = False
+    client = app.test_client()
+    env = app.jinja_env
+    folder = tempfile.mkdtemp()
+    bundle = os.path.join(folder, 'bundle')
+    build(app, bundle)
+    source_loader = app.create_global_jinja_loader()
+    ways = [
+        ('source', source_loader, None),
+        ('bytecode', source_loader,
+         SharedBytecodeCache(folder)),
+        ('bundle', jinja2.ModuleLoader(bundle), None),
+    ]
+    results = {}
+    try:
+        for name, loader, bytecode_cache in ways:
+            env.loader, env.bytecode_cache = loader, bytecode_cache
+            cold, warm = [], []
+            for _ in xrange(repeat + 1):
+                env.cache.clear()
+                for times in (cold, warm):
+                    start = timeit.default_timer()
+                    for url in BENCHMARK_URLS:
+                        client.get(url).data
+                    times.append((timeit.default_timer() - start) * 1000)
+            # The first round fills the bytecode cache.
+            cold, warm = sorted(cold[1:]), sorted(warm[1:])
+            results[name] = (cold[len(cold) // 2], warm[len(warm) // 2])
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def init_app(app):
+    """Loads the templates from the bundle or the bytecode cache.
+
+    Must be called before the first template is loaded.
+
+    Args:
+        app: The flask application.
+    """
+    if config.TEMPLATE_CACHE_DIR:
+        if not os.path.isdir(config.TEMPLATE_CACHE_DIR):
+            os.makedirs(config.TEMPLATE_CACHE_DIR)
+        app.jinja_env.bytecode_cache = SharedBytecodeCache(
+            config.TEMPLATE_CACHE_DIR
+        )
+    if config.TEMPLATE_BUNDLE and bundle_is_current(app,
+                                                    config.TEMPLATE_BUNDLE):
+        app.jinja_env.loader = jinja2.ChoiceLoader([
+            jinja2.ModuleLoader(config.TEMPLATE_BUNDLE), app.jinja_env.loader
+        ])
+
+
+def main(arguments):
+    """Runs the command line interface."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('command', choices=['build', 'benchmark'])
+    parser.add_argument('--output', default=config.TEMPLATE_BUNDLE,
+                        help='folder of the precompiled templates')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='renders of the pages in the benchmark')
+    options = parser.parse_args(arguments)
+
+    import application
+    if options.command == 'build':
+        count = build(application.app, options.output)
+        print 'Compiled %d templates in %s.' % (count, options.output)
+    else:
+        results = benchmark(application.app, options.repeat)
+        print '%-9s %10s %10s' % ('templates', 'cold ms', 'warm ms')
+        for name in ('source', 'bytecode', 'bundle'):
+            print '%-9s %10.2f %10.2f' % ((name,) + results[name])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
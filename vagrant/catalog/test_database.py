@@ -0,0 +1,290 @@
+# coding: utf-8
+"""Checks of the database layer against the configured database.
+
+By default a temporary sqlite file is used. To check PostgreSQL, point
+CATALOG_DATABASE_URL at an empty database, and optionally
+CATALOG_DATABASE_REPLICA_URL at its replica:
+
+    python -m unittest test_database
+    CATALOG_DATABASE_URL=postgresql://vagrant@/catalog_test \\
+        python -m unittest test_database
+
+The tables are dropped at the end, so the database must not have the catalog
+already.
+"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import flask
+import sqlalchemy as sqla
+
+import conditional
+import config
+import database
+import search
+
+_folder = None
+
+
+def setUpModule():
+    global _folder
+    _folder = tempfile.mkdtemp()
+    if not os.environ.get('CATALOG_DATABASE_URL'):
+        config.DATABASE_URL = 'sqlite:///%s' % os.path.join(_folder,
+                                                            'test.sqlite')
+        config.DATABASE_REPLICA_URL = None
+    engine = database.get_engine()
+    with engine.connect() as connection:
+        if engine.dialect.has_table(connection, database.Item.__tablename__):
+            shutil.rmtree(_folder)
+            raise unittest.SkipTest('the database already has the catalog')
+
+
+def tearDownModule():
+    database.dispose_engines()
+    shutil.rmtree(_folder, ignore_errors=True)
+
+
+def _drop_tables():
+    """Drops the tables created by the tests."""
+    database.remove_session()
+    engine = database.get_engine()
+    database.Base.metadata.drop_all(engine)
+    if engine.dialect.name == 'sqlite':
+        engine.execute('DROP TABLE IF EXISTS %s' % database.SEARCH_TABLE)
+
+
+def _create_first_schema(connection):
+    """Creates the tables of the first version of the catalog, before the
+    migrations."""
+    metadata = sqla.MetaData()
+    sqla.Table(
+        'categories', metadata,
+        sqla.Column('id', sqla.Integer, primary_key=True),
+        sqla.Column('name', sqla.String(100), nullable=False),
+        sqla.Column('gplus_id', sqla.String),
+    )
+    sqla.Table(
+        'catalog', metadata,
+        sqla.Column('id', sqla.Integer, primary_key=True),
+        sqla.Column('name', sqla.String(100), nullable=False),
+        sqla.Column('description', sqla.String),
+        sqla.Column('category_id', sqla.ForeignKey('categories.id'),
+                    nullable=False),
+        sqla.Column('image', sqla.String(100)),
+        sqla.Column('datetime', sqla.DateTime),
+        sqla.Column('gplus_id', sqla.String),
+    )
+    metadata.create_all(connection)
+    connection.execute("INSERT INTO categories (id, name) VALUES (1, 'Tools')")
+    connection.execute(
+        sqla.text("INSERT INTO catalog (id, name, description, category_id, "
+                  "image, datetime) VALUES (1, 'Hammer', 'Heavy', 1, "
+                  "'/uploads/hammer.png', :date)"),
+        date=datetime.datetime(2015, 1, 2, 3, 4, 5)
+    )
+
+
+def _check_indexes(test):
+    """Checks that the hot queries use the indexes of the catalog."""
+    if database.get_engine().dialect.name != 'sqlite':
+        test.skipTest('EXPLAIN QUERY PLAN is only available in sqlite')
+    plans = dict((description, plan)
+                 for description, plan, _ in database.explain_queries())
+    test.assertIn('USING INDEX ix_categories_name', plans['category by name'])
+    test.assertIn('USING INDEX ix_catalog_datetime', plans['recent items'])
+    test.assertIn('USING INDEX ix_catalog_category_id_datetime',
+                  plans['category items'])
+
+
+class DatabaseTest(unittest.TestCase):
+    """Creates the schema, writes with get_session and reads with
+    get_read_session."""
+
+    @classmethod
+    def setUpClass(cls):
+        if not database.create_database():
+            raise AssertionError('the database was not created')
+        cls.app = flask.Flask(__name__)
+        cls.app.secret_key = 'test'
+
+    @classmethod
+    def tearDownClass(cls):
+        _drop_tables()
+
+    def tearDown(self):
+        database.remove_session()
+
+    def _add_item(self, category_name, name):
+        """Adds an item through the session of the controllers that write."""
+        db_session = database.get_session()
+        category = database.Category(name=category_name)
+        item = database.Item(name=name, description='%s item' % name,
+                             category=category)
+        db_session.add(item)
+        db_session.commit()
+        return item.id
+
+    def test_migrations_are_recorded(self):
+        with database.get_engine().connect() as connection:
+            applied = database._applied_versions(connection)
+        self.assertEqual(set(version for version, _, _ in
+                             database.MIGRATIONS), applied)
+
+    def test_queries_use_the_indexes(self):
+        _check_indexes(self)
+
+    def test_write_then_read(self):
+        item_id = self._add_item('Tools', 'Hammer')
+        database.remove_session()
+        with self.app.test_request_context('/'):
+            item = database.get_read_session().query(database.Item).get(
+                item_id
+            )
+            self.assertEqual('Hammer', item.name)
+            self.assertEqual('Tools', item.category.name)
+
+    def test_reads_go_to_primary_after_a_change(self):
+        with self.app.test_request_context('/'):
+            flask.session['primary_until'] = time.time() + 10
+            self.assertIs(database.get_session(),
+                          database.get_read_session())
+        with self.app.test_request_context('/'):
+            read_session = database.get_read_session()
+            self.assertIs(database.get_read_engine(), read_session.bind)
+            if not config.DATABASE_REPLICA_URL:
+                self.assertIs(database.get_engine(), read_session.bind)
+
+    def test_versions(self):
+        db_session = database.get_session()
+        before = database.get_version(db_session, 'test')
+        database.bump_version(db_session, 'test')
+        db_session.commit()
+        database.remove_session()
+        self.assertEqual(before + 1,
+                         database.get_version(database.get_session(), 'test'))
+
+    def test_catalog_has_a_date(self):
+        version, last_modified = conditional.catalog_stamp(
+            database.get_session()
+        )
+        self.assertEqual(0, version)
+        self.assertIsInstance(last_modified, datetime.datetime)
+
+    def test_category_names_fit_the_urls(self):
+        self.assertTrue(database.valid_category_name(u'Power tools'))
+        for name in ('', None, 'a/b', 'report.json'):
+            self.assertFalse(database.valid_category_name(name))
+
+    def test_search(self):
+        item_id = self._add_item('Lamps', 'Brass lamp')
+        database.remove_session()
+        items, _ = search.search_items(database.get_read_session(), 'brass')
+        self.assertIn(item_id, [item.id for item in items])
+
+
+class MigrationTest(unittest.TestCase):
+    """Migrates a database created by the first version of the catalog."""
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            with database.get_engine().begin() as connection:
+                _create_first_schema(connection)
+            cls.applied = database.migrate_database()
+        except:
+            _drop_tables()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        _drop_tables()
+
+    def tearDown(self):
+        database.remove_session()
+
+    def test_applies_every_migration(self):
+        self.assertEqual([version for version, _, _ in database.MIGRATIONS],
+                         [version for version, _ in self.applied])
+        self.assertEqual([], database.migrate_database())
+
+    def test_keeps_the_items(self):
+        item = database.get_session().query(database.Item).one()
+        self.assertEqual('Hammer', item.name)
+        self.assertEqual('Tools', item.category.name)
+        self.assertEqual(item.datetime, item.updated)
+        self.assertIsNone(item.thumbnail)
+
+    def test_queries_use_the_indexes(self):
+        _check_indexes(self)
+
+    def test_dates_the_catalog_with_the_last_item(self):
+        self.assertEqual((0, datetime.datetime(2015, 1, 2, 3, 4, 5)),
+                         conditional.catalog_stamp(database.get_session()))
+
+    def test_counts_the_uploads(self):
+        upload = database.get_session().query(database.Upload).one()
+        self.assertEqual(('hammer.png', 1), (upload.filename, upload.refcount))
+
+
+
+class PageQueriesTest(unittest.TestCase):
+    """Counts the statements of the pages, once the caches of the process
+    are filled, so a change that adds queries to a page is noticed."""
+
+    @classmethod
+    def setUpClass(cls):
+        database.create_database()
+        database.fill_default_data()
+        config.SESSION_DATABASE = os.path.join(_folder, 'sessions.sqlite')
+        config.TEMPLATE_CACHE_DIR = None
+        config.PAGE_CACHE_ENABLED = False
+        import application
+        cls.client = application.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        _drop_tables()
+
+    def assertQueries(self, count, url):
+        """Checks the number of statements of the second request of a page.
+        """
+        self.client.get(url).data
+        with database.count_queries() as statements:
+            response = self.client.get(url)
+            response.data
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(count, len(statements), '\n'.join(statements))
+
+    def test_home(self):
+        # The versions of the recent items and of the categories.
+        self.assertQueries(2, '/')
+
+    def test_category(self):
+        # The categories version, the category, its stamp and its items.
+        self.assertQueries(4, '/catalog/Fruits')
+
+    def test_item(self):
+        # The categories version, and the item with its category.
+        self.assertQueries(2, '/catalog/Fruits/6')
+
+    def test_catalog_json(self):
+        # The catalog stamp, and all the rows in a single query.
+        self.assertQueries(2, '/catalog.json')
+
+    def test_catalog_json_is_dated(self):
+        response = self.client.get('/catalog.json')
+        self.assertIsNotNone(response.last_modified)
+        response = self.client.get('/catalog.json', headers={
+            'If-Modified-Since': response.headers['Last-Modified']
+        })
+        self.assertEqual(304, response.status_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+# coding: utf-8
+"""Checks the calls to Google of the login against a local stub server.
+
+    python -m unittest test_login
+"""
+
+import base64
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import unittest
+import urlparse
+
+import config
+import login
+import lru
+
+# Seconds that the stub server takes to answer the token information and the
+# user profile.
+DELAY = 0.3
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Imitates the Google endpoints used by the login.
+
+    Attributes:
+        requests: List of (path, start, end) of the answered requests.
+        tokeninfo: Answer of the token information endpoint.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.requests = []
+        self.tokeninfo = {'user_id': 'g1', 'issued_to': login.CLIENT_ID}
+
+    def url(self, path):
+        """Returns the url of a path of the server."""
+        return 'http://127.0.0.1:%d%s' % (self.server_port, path)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers the requests of the StubServer."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body):
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        start = time.time()
+        self.rfile.read(int(self.headers['Content-Length']))
+        payload = base64.urlsafe_b64encode(json.dumps({'sub': 'g1'}))
+        self._reply({'access_token': 'token', 'expires_in': 3600,
+                     'id_token': 'header.%s.signature' % payload.rstrip('=')})
+        self.server.requests.append(('/token', start, time.time()))
+
+    def do_GET(self):
+        start = time.time()
+        path = urlparse.urlparse(self.path).path
+        time.sleep(DELAY)
+        if path == '/tokeninfo':
+            self._reply(self.server.tokeninfo)
+        else:
+            self._reply({'name': 'Ann', 'picture': 'picture.png',
+                         'email': 'ann@example.com'})
+        self.server.requests.append((path, start, time.time()))
+
+
+class LoginTest(unittest.TestCase):
+    """Calls the functions of the login that request the stub server."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubServer()
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.urls = (config.GOOGLE_TOKEN_URL, config.GOOGLE_TOKENINFO_URL,
+                    config.GOOGLE_USERINFO_URL)
+        config.GOOGLE_TOKEN_URL = cls.server.url('/token')
+        config.GOOGLE_TOKENINFO_URL = cls.server.url('/tokeninfo')
+        config.GOOGLE_USERINFO_URL = cls.server.url('/userinfo')
+
+    @classmethod
+    def tearDownClass(cls):
+        # Closes the keep-alive connections, that the stub server waits on.
+        login._http.close()
+        cls.server.shutdown()
+        cls.server.server_close()
+        (config.GOOGLE_TOKEN_URL, config.GOOGLE_TOKENINFO_URL,
+         config.GOOGLE_USERINFO_URL) = cls.urls
+
+    def setUp(self):
+        login._tokens.clear()
+        del self.server.requests[:]
+        self.server.tokeninfo = {'user_id': 'g1',
+                                 'issued_to': login.CLIENT_ID}
+
+    def test_exchange_code(self):
+        credentials = login.exchange_code('code')
+        self.assertEqual('token', credentials.access_token)
+        self.assertEqual('g1', credentials.id_token['sub'])
+
+    def test_details_are_requested_at_the_same_time(self):
+        tokeninfo, userinfo = login.token_details('token')
+        self.assertEqual('g1', tokeninfo['user_id'])
+        self.assertEqual('Ann', userinfo['name'])
+        (first, start, _), (second, _, end) = sorted(
+            self.server.requests, key=lambda request: request[1]
+        )
+        self.assertEqual(set(['/tokeninfo', '/userinfo']),
+                         set([first, second]))
+        # The second request started before the first one was answered.
+        self.assertLess(end - start, 2 * DELAY)
+
+    def test_details_are_cached(self):
+        details = login.token_details('token')
+        self.assertEqual(details, login.token_details('token'))
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_cache_expires(self):
+        self.assertEqual(60, config.GOOGLE_TOKEN_CACHE_TTL)
+        login.token_details('token')
+        now = time.time()
+        clock = lru.time.time
+        lru.time.time = lambda: now + config.GOOGLE_TOKEN_CACHE_TTL + 1
+        try:
+            login.token_details('token')
+        finally:
+            lru.time.time = clock
+        self.assertEqual(4, len(self.server.requests))
+
+    def test_errors_are_not_cached(self):
+        self.server.tokeninfo = {'error': 'invalid_token'}
+        login.token_details('token')
+        login.token_details('token')
+        self.assertEqual(4, len(self.server.requests))
+
+
+if __name__ == '__main__':
+    unittest.main()
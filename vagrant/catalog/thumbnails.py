@@ -0,0 +1,124 @@
+# coding: utf-8
+"""Background generation of the resized versions of the uploaded images.
+
+The controllers schedule the images after they commit, and a pool of worker
+threads resizes them, so the requests don't wait. When the files are ready
+the routes are saved in the items that use the image. Until then, the
+templates show the original image.
+
+Resizing needs the Python Imaging Library (Pillow). Without it, nothing is
+scheduled and the original images are always used.
+"""
+
+import logging
+import os
+import posixpath
+from multiprocessing import pool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import conditional
+import config
+import database
+import file_upload
+import page_cache
+import recent_items
+
+SIZES = {
+    'thumbnail': config.THUMBNAIL_SIZE,
+    'detail': config.DETAIL_SIZE,
+}
+
+_pool = None
+
+
+def _get_pool():
+    """Returns the pool of worker threads, created on first use."""
+    global _pool
+    if _pool is None:
+        _pool = pool.ThreadPool(config.THUMBNAIL_WORKERS)
+    return _pool
+
+
+def reset_after_fork():
+    """Forgets the worker threads after a fork.
+
+    The workers only run in the parent process, so the next call to schedule
+    creates the pool again.
+    """
+    global _pool
+    _pool = None
+
+
+def schedule(route):
+    """Generates the resized versions of an image in the background.
+
+    Must be called after the items that use the image are commited.
+
+    Args:
+        route: Route of the uploaded image.
+    """
+    if Image is None or not route:
+        return
+    _get_pool().apply_async(_generate, (route,))
+
+
+def _resize(path, target, size):
+    """Saves a copy of the image that fits in the size."""
+    if os.path.exists(target):
+        return
+    image = Image.open(path)
+    image_format = image.format
+    image.thumbnail(size, Image.ANTIALIAS)
+    if (target.rsplit('.', 1)[1].lower() in ('jpg', 'jpeg') and
+            image.mode not in ('RGB', 'L')):
+        image = image.convert('RGB')
+    temp_target = '%s.tmp' % target
+    image.save(temp_target, format=image_format)
+    os.rename(temp_target, target)
+
+
+def _generate(route):
+    """Resizes an image and saves the new routes in the items that use it."""
+    try:
+        _save_derivatives(route)
+    except Exception:
+        logging.exception('Could not resize %s', route)
+
+
+def _save_derivatives(route):
+    """Creates the resized files and saves their routes in the items."""
+    filename = posixpath.basename(route)
+    folder = file_upload.upload_folder()
+    routes = {}
+    for kind, size in SIZES.items():
+        name = file_upload.derivative_name(filename, kind)
+        try:
+            _resize(os.path.join(folder, filename), os.path.join(folder, name),
+                    size)
+        except (IOError, OSError):
+            # The original was deleted or is not an image, keep using it.
+            return
+        routes[kind] = posixpath.join(posixpath.dirname(route), name)
+
+    db_session = database.get_session()
+    try:
+        items = db_session.query(database.Item).filter(
+            database.Item.image == route
+        ).all()
+        if not items:
+            return
+        pages = set()
+        for item in items:
+            item.thumbnail = routes['thumbnail']
+            item.detail_image = routes['detail']
+            pages.update(page_cache.item_tags(item))
+        conditional.catalog_changed(db_session)
+        recent_items.changed(db_session)
+        page_cache.invalidate(db_session, *pages)
+        db_session.commit()
+    finally:
+        database.remove_session()